@@ -1,11 +1,14 @@
 from __future__ import print_function
 from __future__ import division
 
+import os
+import ast
 import sys
 import json
 import csv
 import multiprocessing as mp
 
+import numpy as np
 import pandas as pd
 
 # Minimal number of nucleotides to make alignment
@@ -41,252 +44,359 @@ CODONS = {}
 for aa, codon in CODON_LIST:
     CODONS[aa] = CODONS.get(aa, []) + [codon]
 
-
-def align_nuc_to_aa(seq, gene):
-    def _align_slice(codon_pos, gene_symbol, aminoacid, prev_aligned=[True] * 6):
-        aligned = [False] * 6
-        for i, codon in enumerate(CODONS[aminoacid]):
-            aligned[i] = prev_aligned[i] & (codon[codon_pos] == gene_symbol)
-        return sum(aligned) > 0, aligned
-
+# nucleotide codes, any other symbol is encoded as NUCLEOTIDE_PAD and never aligns
+NUCLEOTIDE_CODES = {'A': 0, 'C': 1, 'G': 2, 'T': 3}
+NUCLEOTIDE_PAD = 4
+AMINO_ACID_CODES = {aa: i for i, aa in enumerate(CODONS.keys())}
+UNKNOWN_AMINO_ACID = len(AMINO_ACID_CODES)
+
+# CODON_MASKS[amino acid, codon position, nucleotide] has i-th bit set if i-th codon of
+# the amino acid has the nucleotide at the codon position
+CODON_MASKS = np.zeros((UNKNOWN_AMINO_ACID + 1, 3, NUCLEOTIDE_PAD + 1), dtype=np.uint8)
+for aa, codons in CODONS.items():
+    for i, codon in enumerate(codons):
+        for codon_pos, nucleotide in enumerate(codon):
+            CODON_MASKS[AMINO_ACID_CODES[aa], codon_pos, NUCLEOTIDE_CODES[nucleotide]] |= 1 << i
+
+
+def encode_germlines(genes, reverse=False):
+    """
+    Encodes nucleotide sequences into a padded matrix of nucleotide codes
+    :param genes: nucleotide sequences
+    :param reverse: if True sequences are stored from 3' end
+    :return: matrix of nucleotide codes, one germline per row
+    """
+    genes = [gene[::-1] if reverse else gene for gene in genes]
+    germlines = np.full((len(genes), max([len(gene) for gene in genes], default=0)), NUCLEOTIDE_PAD, dtype=np.uint8)
+    for i, gene in enumerate(genes):
+        germlines[i, :len(gene)] = [NUCLEOTIDE_CODES.get(nucleotide, NUCLEOTIDE_PAD) for nucleotide in gene]
+    return germlines
+
+
+def score_germlines(seq, germlines, reverse=False):
+    """
+    Aligns amino acid sequence to all germlines at once, see align_nuc_to_aa
+    :param seq: amino acid sequence
+    :param germlines: matrix of germline nucleotide codes from encode_germlines
+    :param reverse: if True germlines were encoded from 3' end and alignment starts from the end of seq
+    :return: number of aligned nucleotides for every germline
+    """
+    scores = np.zeros(len(germlines), dtype=np.int64)
+    aligned = np.ones(len(germlines), dtype=bool)
+    codon_positions = (2, 1, 0) if reverse else (0, 1, 2)
+
+    for aa_pos, aa in enumerate(reversed(seq) if reverse else seq):
+        codon_masks = CODON_MASKS[AMINO_ACID_CODES.get(aa, UNKNOWN_AMINO_ACID)]
+        codons = np.full(len(germlines), 0xFF, dtype=np.uint8)
+        for i, codon_pos in enumerate(codon_positions):
+            nuc_pos = aa_pos * 3 + i
+            if nuc_pos >= germlines.shape[1]:
+                return scores
+            codons &= codon_masks[codon_pos][germlines[:, nuc_pos]]
+            aligned &= codons != 0
+            if not aligned.any():
+                return scores
+            scores += aligned
+
+    return scores
+
+
+def _align_masks(seq, gene, codon_positions):
     score = 0
-
-    flag = False
-
     for aa_pos, aa in enumerate(seq):
-        if aa_pos * 3 < len(gene):
-            flag, aligned = _align_slice(0, gene[aa_pos * 3], aa)
-
-            if flag:
-                score += 1
-
-                if (aa_pos * 3 + 1) < len(gene):
-                    flag, aligned = _align_slice(1, gene[aa_pos * 3 + 1], aa, aligned)
-
-                    if flag:
-                        score += 1
-
-                        if (aa_pos * 3 + 2) < len(gene):
-                            flag, aligned = _align_slice(2, gene[aa_pos * 3 + 2], aa, aligned)
-
-                            score += flag
-        if not flag:
-            break
-
+        codon_masks = CODON_MASKS[AMINO_ACID_CODES.get(aa, UNKNOWN_AMINO_ACID)]
+        codons = 0xFF
+        for i, codon_pos in enumerate(codon_positions):
+            nuc_pos = aa_pos * 3 + i
+            if nuc_pos >= len(gene):
+                return score
+            codons &= codon_masks[codon_pos, NUCLEOTIDE_CODES.get(gene[nuc_pos], NUCLEOTIDE_PAD)]
+            if not codons:
+                return score
+            score += 1
     return score
 
 
-def align_nuc_to_aa_rev(seq, gene):
-    def _align_slice(codon_pos, gene_symbol, aminoacid, prev_aligned=[True] * 6):
-        aligned = [False] * 6
-        for i, codon in enumerate(CODONS[aminoacid]):
-            aligned[i] = prev_aligned[i] & (codon[codon_pos] == gene_symbol)
-        return sum(aligned) > 0, aligned
-
-    score = 0
-
-    for aa_pos, aa in enumerate(reversed(seq)):
-        if aa_pos * 3 < len(gene):
-            flag, aligned = _align_slice(2, gene[-(aa_pos * 3 + 1)], aa)
-
-            if flag:
-                score += 1
-
-                if (aa_pos * 3 + 1) < len(gene):
-                    flag, aligned = _align_slice(1, gene[-(aa_pos * 3 + 2)], aa, aligned)
-
-                    if flag:
-                        score += 1
-
-                        if (aa_pos * 3 + 2) < len(gene):
-                            flag, aligned = _align_slice(0, gene[-(aa_pos * 3 + 3)], aa, aligned)
-
-                            score += flag
-        if not flag:
-            break
-
-    return score
+def align_nuc_to_aa(seq, gene):
+    """
+    :param seq: amino acid sequence
+    :param gene: nucleotide sequence of the germline
+    :return: number of nucleotides of the germline start that can encode the start of seq
+    """
+    return _align_masks(seq, gene, (0, 1, 2))
 
 
-def fix_json(row):
-    cdr3 = row[0]
-    res_v_id = "null"
-    res_v_score = -1
-    res_j_id = "null"
-    res_j_score = -1
-    if not (type(cdr3) is float):
-        seg_gene_type = row[1]
-        species = row[2]
-
-        # VARIABLE
-        for _, seg_row in segments[(segments.species == species) & (segments.gene == seg_gene_type) & (
-                segments.segment == "Variable")].iterrows():
-            cur_score = align_nuc_to_aa(cdr3, seg_row["seq"][seg_row["ref"] - 3:])
-            if cur_score > res_v_score:
-                if cur_score >= MIN_NUC_V:
-                    res_v_score = cur_score
-                    res_v_id = seg_row["id"]
-        # elif cur_score == res_v_score:
-        # 	res_v_id = res_v_id + "," + seg_row["id"]
-
-        # JOINING
-        for _, seg_row in segments[(segments.species == species) & (segments.gene == seg_gene_type) & (
-                segments.segment == "Joining")].iterrows():
-            cur_score = align_nuc_to_aa_rev(cdr3, seg_row["seq"][:seg_row["ref"] + 4])
-            if cur_score > res_j_score:
-                if cur_score >= MIN_NUC_J:
-                    res_j_score = cur_score
-                    res_j_id = seg_row["id"]
-        # elif cur_score == res_j_score:
-        # 	res_j_id = res_j_id + "," + seg_row["id"]
-
-    return res_v_id, res_v_score // 3, res_j_id, res_j_score // 3
-
-
-def update_segments(index, old_row, new_row, gene_type, single_col, stats, df):
-    seg_gene_type = ""
-    if gene_type == ".alpha":
-        seg_gene_type = "TRA"
-    elif gene_type == ".beta":
-        seg_gene_type = "TRB"
+def align_nuc_to_aa_rev(seq, gene):
+    """
+    :param seq: amino acid sequence
+    :param gene: nucleotide sequence of the germline
+    :return: number of nucleotides of the germline end that can encode the end of seq
+    """
+    return _align_masks(seq[::-1], gene[::-1], (2, 1, 0))
+
+
+def _best_germline(scores, ids, min_score):
+    """
+    :return: first germline id with the best score and the score if it is at least min_score, else ("null", -1)
+    """
+    if not len(scores):
+        return "null", -1
+    best = int(np.argmax(scores))
+    if scores[best] < min_score:
+        return "null", -1
+    return ids[best], int(scores[best])
+
+
+class GermlineIndex:
+    """
+    Immutable index of trimmed and encoded germlines by (species, gene, segment type)
+    """
+    def __init__(self, segments):
+        """
+        :param segments: segments table with species, gene, segment, id, ref and seq columns
+        """
+        groups = {}
+        for (species, gene, segment), group in segments.groupby(["species", "gene", "segment"], sort=False):
+            if segment == "Variable":
+                germlines = encode_germlines([seq[ref - 3:] for seq, ref in zip(group["seq"], group["ref"])])
+            elif segment == "Joining":
+                germlines = encode_germlines([seq[:ref + 4] for seq, ref in zip(group["seq"], group["ref"])], True)
+            else:
+                continue
+            germlines.flags.writeable = False
+            groups[(species, gene, segment)] = (tuple(group["id"]), germlines)
+        self._groups = groups
+
+    def get(self, species, gene, segment):
+        """
+        :return: tuple of germline ids and matrix of their codes, see encode_germlines
+        """
+        return self._groups.get((species, gene, segment), ((), EMPTY_GERMLINES))
+
+
+EMPTY_GERMLINES = np.zeros((0, 0), dtype=np.uint8)
+
+# germline index of the realignment process, set by init_worker
+germline_index = None
+
+
+def make_germline_index(segments):
+    """
+    :param segments: segments.txt table as read by pandas, e.g. Cdr3Fixer.segments
+    :return: GermlineIndex of the segments
+    """
+    return GermlineIndex(segments.set_axis(["species", "gene", "segment", "id", "ref", "seq"], axis=1))
+
+
+def load_germline_index(segments_file_name):
+    """
+    :param segments_file_name: path to segments.txt
+    :return: GermlineIndex of the segments
+    """
+    return make_germline_index(pd.read_csv(segments_file_name, sep="\t"))
+
+
+def init_worker(index):
+    global germline_index
+    germline_index = index
+
+
+def fix_json(rows):
+    """
+    Realigns batch of cdr3 sequences to germlines
+    :param rows: list of (cdr3, gene, species) tuples
+    :return: list of (V id, V end, J id, J start from the end) tuples, "null" and -1 if not aligned
+    """
+    results = []
+    for cdr3, seg_gene_type, species in rows:
+        res_v_id = "null"
+        res_v_score = -1
+        res_j_id = "null"
+        res_j_score = -1
+        if not (type(cdr3) is float):
+            # VARIABLE
+            ids, germlines = germline_index.get(species, seg_gene_type, "Variable")
+            res_v_id, res_v_score = _best_germline(score_germlines(cdr3, germlines), ids, MIN_NUC_V)
+
+            # JOINING
+            ids, germlines = germline_index.get(species, seg_gene_type, "Joining")
+            res_j_id, res_j_score = _best_germline(score_germlines(cdr3, germlines, True), ids, MIN_NUC_J)
+
+        results.append((res_v_id, res_v_score // 3, res_j_id, res_j_score // 3))
+    return results
+
+
+def realign_all(rows, index, jobs=None, batch_size=256):
+    """
+    Realigns cdr3 sequences in worker processes receiving germline index once via pool initializer
+    :param rows: list of (cdr3, gene, species) tuples
+    :param index: GermlineIndex
+    :param jobs: number of worker processes, all CPUs by default, realigns in current process if 1
+    :param batch_size: number of cdr3 sequences per task
+    :return: list of fix_json results aligned with rows
+    """
+    jobs = jobs or mp.cpu_count()
+    batches = [rows[i:i + batch_size] for i in range(0, len(rows), batch_size)]
+    if jobs > 1 and len(batches) > 1:
+        with mp.Pool(min(jobs, len(batches)), initializer=init_worker, initargs=(index,)) as pool:
+            results = pool.map(fix_json, batches)
     else:
-        print("Error: unknown gene type", gene_type)
-        return 0
-
-    if single_col:
-        gene_type = ""
-
-    if not pd.isnull(row["cdr3fix" + gene_type]):
-        json_val = json.loads(row["cdr3fix" + gene_type])
-
-        if new_row[1] != -1:
-            if new_row[0] == json_val["vId"]:
-                if new_row[1] > json_val["vEnd"]:
-                    json_val["oldVEnd"] = json_val["vEnd"]
-                    json_val["vEnd"] = new_row[1]
-
-                    json_val["oldVFixType"] = json_val["vFixType"]
-                    json_val["vFixType"] = "Realign"
-            elif (new_row[1] - json_val["vEnd"]) >= MIN_DIFF_V:
-                json_val["oldVId"] = json_val["vId"]
-                json_val["vId"] = new_row[0]
-
-                json_val["oldVEnd"] = json_val["vEnd"]
-                json_val["vEnd"] = new_row[1]
-
-                json_val["oldVFixType"] = json_val["vFixType"]
-                json_val["vFixType"] = "ChangeSegment"
-
-        # if (new_row[1] - json_val["vEnd"]) >= MIN_DIFF_V:
-        # 	json_val["oldVId"] = json_val["vId"]
-        # 	json_val["vId"] = new_row[0]
-        # 	json_val["oldVEnd"] = json_val["vEnd"]
-        # 	json_val["vEnd"] = new_row[1]
-        # 	json_val["oldVFixType"] = json_val["vFixType"]
-        # 	if json_val["oldVId"] != json_val["vId"]:
-        # 		temp_s = "v_" + str(json_val["oldVId"]) + "->" + json_val["vId"] + ":" + str(json_val["oldVEnd"]) + "->" + str(json_val["vEnd"])
-        # 		stats[temp_s] = stats.get(temp_s, 0) + 1
-
-        # 	if json_val["vId"] == json_val["oldVId"]:
-        # 		json_val["vFixType"] = "Realign"
-        # 	else:
-        # 		json_val["vFixType"] = "ChangeSegment"
-
-        if new_row[3] != -1:
-            if new_row[2] == json_val["jId"]:
-                if json_val["jStart"] > (len(row["cdr3" + gene_type]) - new_row[3]):
-                    json_val["oldJStart"] = json_val["jStart"]
-                    json_val["jStart"] = len(row["cdr3" + gene_type]) - new_row[3]
-
-                    json_val["oldJFixType"] = json_val["jFixType"]
-                    json_val["jFixType"] = "Realign"
-            elif json_val["jStart"] - (len(row["cdr3" + gene_type]) - new_row[3]) >= MIN_DIFF_J:
-                json_val["oldJId"] = json_val["jId"]
-                json_val["jId"] = new_row[2]
-
-                json_val["oldJStart"] = json_val["jStart"]
-                json_val["jStart"] = len(row["cdr3" + gene_type]) - new_row[3]
-
-                json_val["oldJFixType"] = json_val["jFixType"]
-                json_val["jFixType"] = "ChangeSegment"
-
-        # if (new_row[3] != -1) and ((json_val["jStart"] == -1) or (json_val["jStart"] - (len(row["cdr3" + gene_type]) - new_row[3]) >= MIN_DIFF_J)):
-        # 	json_val["oldJId"] = json_val["jId"]
-        # 	json_val["jId"] = new_row[2]
-        # 	json_val["oldJStart"] = json_val["jStart"]
-        # 	json_val["jStart"] = len(row["cdr3" + gene_type]) - new_row[3]
-        # 	json_val["oldJFixType"] = json_val["jFixType"]
-        # 	if json_val["oldJId"] != json_val["jId"]:
-        # 		temp_s = "j_" + str(json_val["oldJId"]) + "->" + json_val["jId"] + ":" + str(json_val["oldJStart"]) + "->" + str(json_val["jStart"])
-        # 		stats[temp_s] = stats.get(temp_s, 0) + 1
-
-        # 	if json_val["jId"] == json_val["oldJId"]:
-        # 		json_val["jFixType"] = "Realign"
-        # 	else:
-        # 		json_val["jFixType"] = "ChangeSegment"
-
-        # FINALISATION
-        json_val["good"] = (json_val["vEnd"] != -1) and (json_val["jStart"] != -1)
-
-        df.set_value(index, "cdr3fix" + gene_type, json.dumps(json_val, sort_keys=True))
-
-        if gene_type == "":
-            gene_type = ".segm"
-        df.set_value(index, "v" + gene_type, json_val["vId"])
-        df.set_value(index, "j" + gene_type, json_val["jId"])
-
-    return df
+        init_worker(index)
+        results = map(fix_json, batches)
+    return [result for batch_results in results for result in batch_results]
+
+
+def _decode_fix(value):
+    """
+    :param value: cdr3fix value, a dict, its json dump or its repr as written to vdjdb_full.txt
+    :return: cdr3fix dict
+    """
+    if not isinstance(value, str):
+        return dict(value)
+    try:
+        return json.loads(value)
+    except ValueError:
+        return ast.literal_eval(value)
+
+
+def update_segments(df, realigned, cdr3_column, cdr3fix_column, v_column, j_column):
+    """
+    Applies realignment results to the table in bulk. V (J) segment is realigned if the same segment
+    covers more of cdr3 and changed if another segment covers at least MIN_DIFF_V (MIN_DIFF_J) more
+    :param df: table with cdr3, cdr3fix, V and J columns, cdr3fix values are json strings or dicts
+    :param realigned: list of fix_json results aligned with df rows
+    :param cdr3_column: cdr3 column name
+    :param cdr3fix_column: cdr3fix column name
+    :param v_column: V segment column name
+    :param j_column: J segment column name
+    :return: updated table and frame of segment, old.id, new.id, old.pos, new.pos of every updated segment
+    """
+    rows = np.flatnonzero(df[cdr3fix_column].notnull().to_numpy())
+    fixes = [_decode_fix(value) for value in df[cdr3fix_column].to_numpy()[rows]]
+    realigned = [realigned[row] for row in rows]
+    cdr3_lengths = np.array([len(cdr3) for cdr3 in df[cdr3_column].to_numpy()[rows]], dtype=np.int64)
+
+    v_id = np.array([fix["vId"] for fix in fixes], dtype=object)
+    v_end = np.array([fix["vEnd"] for fix in fixes], dtype=np.int64)
+    j_id = np.array([fix["jId"] for fix in fixes], dtype=object)
+    j_start = np.array([fix["jStart"] for fix in fixes], dtype=np.int64)
+    new_v_id = np.array([result[0] for result in realigned], dtype=object)
+    new_v_end = np.array([result[1] for result in realigned], dtype=np.int64)
+    new_j_id = np.array([result[2] for result in realigned], dtype=object)
+    new_j_end = np.array([result[3] for result in realigned], dtype=np.int64)
+    new_j_start = cdr3_lengths - new_j_end
+
+    same_v = (new_v_end != -1) & (new_v_id == v_id)
+    v_fix_types = np.select([same_v & (new_v_end > v_end),
+                             (new_v_end != -1) & ~same_v & (new_v_end - v_end >= MIN_DIFF_V)],
+                            ["Realign", "ChangeSegment"], "")
+    same_j = (new_j_end != -1) & (new_j_id == j_id)
+    j_fix_types = np.select([same_j & (j_start > new_j_start),
+                             (new_j_end != -1) & ~same_j & (j_start - new_j_start >= MIN_DIFF_J)],
+                            ["Realign", "ChangeSegment"], "")
+
+    v_updated = v_fix_types != ""
+    j_updated = j_fix_types != ""
+    final_v_id = np.where(v_updated, new_v_id, v_id)
+    final_v_end = np.where(v_updated, new_v_end, v_end)
+    final_j_id = np.where(j_updated, new_j_id, j_id)
+    final_j_start = np.where(j_updated, new_j_start, j_start)
+    good = (final_v_end != -1) & (final_j_start != -1)
+
+    for i in np.flatnonzero(v_updated):
+        fix = fixes[i]
+        if v_fix_types[i] == "ChangeSegment":
+            fix["oldVId"] = fix["vId"]
+            fix["vId"] = final_v_id[i]
+        fix["oldVEnd"] = fix["vEnd"]
+        fix["vEnd"] = int(final_v_end[i])
+        fix["oldVFixType"] = fix["vFixType"]
+        fix["vFixType"] = str(v_fix_types[i])
+    for i in np.flatnonzero(j_updated):
+        fix = fixes[i]
+        if j_fix_types[i] == "ChangeSegment":
+            fix["oldJId"] = fix["jId"]
+            fix["jId"] = final_j_id[i]
+        fix["oldJStart"] = fix["jStart"]
+        fix["jStart"] = int(final_j_start[i])
+        fix["oldJFixType"] = fix["jFixType"]
+        fix["jFixType"] = str(j_fix_types[i])
+    for fix, fix_good in zip(fixes, good.tolist()):
+        fix["good"] = fix_good
+
+    encoded = np.empty(len(fixes), dtype=object)
+    encoded[:] = [json.dumps(fix, sort_keys=True) for fix in fixes] \
+        if len(rows) and isinstance(df[cdr3fix_column].iat[rows[0]], str) else fixes
+    df = df.copy()
+    for column, values in ((cdr3fix_column, encoded), (v_column, final_v_id), (j_column, final_j_id)):
+        column_values = df[column].to_numpy(dtype=object, copy=True)
+        column_values[rows] = values
+        df[column] = column_values
+
+    updates = pd.concat([pd.DataFrame({"segment": "v", "old.id": v_id[v_updated], "new.id": final_v_id[v_updated],
+                                       "old.pos": v_end[v_updated], "new.pos": final_v_end[v_updated]}),
+                         pd.DataFrame({"segment": "j", "old.id": j_id[j_updated], "new.id": final_j_id[j_updated],
+                                       "old.pos": j_start[j_updated], "new.pos": final_j_start[j_updated]})],
+                        ignore_index=True)
+    return df, updates
+
+
+def write_stats(updates, stats_file_name):
+    """
+    Writes counts of segment updates in "segment_old->new:oldPos->newPos" format, most frequent first
+    :param updates: frames of segment updates returned by update_segments
+    :param stats_file_name: path to the output file
+    """
+    updates = pd.concat(updates, ignore_index=True)
+    counts = updates.groupby(["segment", "old.id", "new.id", "old.pos", "new.pos"]).size() \
+        .sort_values(ascending=False, kind="stable")
+    os.makedirs(os.path.dirname(stats_file_name) or ".", exist_ok=True)
+    with open(stats_file_name, "w") as file:
+        for (segment, old_id, new_id, old_pos, new_pos), count in counts.items():
+            print(f"{segment}_{old_id}->{new_id}:{old_pos}->{new_pos}", count, sep="\t", file=file)
 
 
 def json2tuples(df, cdr3seqcol, seg_gene_type):
-    # json.loads(row["cdr3fix" + gene_type])
-    return [(row[cdr3seqcol], seg_gene_type, row["species"]) for _, row in df.iterrows()]
+    return list(zip(df[cdr3seqcol], [seg_gene_type] * len(df), df["species"]))
 
 
 def json2tuples2(df, cdr3seqcol):
-    # json.loads(row["cdr3fix" + gene_type])
-    return [(row[cdr3seqcol], row["gene"], row["species"]) for _, row in df.iterrows()]
-
-
-def process_all(full_db, db):
-    segments = pd.read_csv("../res/segments.txt", sep="\t")
-    segments.columns = ["species", "gene", "segment", "id", "ref", "seq"]
+    return list(zip(df[cdr3seqcol], df["gene"], df["species"]))
 
-    pool = mp.Pool(mp.cpu_count())
 
+def realign_tables(full_db, db, segments_index):
+    """
+    Realigns segments of both vdjdb_full.txt and vdjdb.txt tables
+    :param full_db: vdjdb_full.txt table
+    :param db: vdjdb.txt table
+    :param segments_index: GermlineIndex
+    :return: updated full_db and db tables
+    """
     print("-- processing the vdjdb_full.txt table")
-    a_js = json2tuples(full_db, "cdr3.alpha", "TRA")
-    b_js = json2tuples(full_db, "cdr3.beta", "TRB")
-    a_js = pool.map(fix_json, a_js)
-    b_js = pool.map(fix_json, b_js)
+    a_js = realign_all(json2tuples(full_db, "cdr3.alpha", "TRA"), segments_index)
+    b_js = realign_all(json2tuples(full_db, "cdr3.beta", "TRB"), segments_index)
 
     print("-- writing")
-    stats = {}
-    for index, row in full_db.iterrows():
-        full_db = update_segments(index, row, a_js[index], ".alpha", False, stats, df=full_db)
-        full_db = update_segments(index, row, b_js[index], ".beta", False, stats, df=full_db)
-    with open("../tmp/stats.full.txt", "w") as file:
-        for s, v in sorted(stats.items(), key=lambda x: x[1], reverse=True):
-            print(s, v, sep="\t", file=file)
+    full_db, a_updates = update_segments(full_db, a_js, "cdr3.alpha", "cdr3fix.alpha", "v.alpha", "j.alpha")
+    full_db, b_updates = update_segments(full_db, b_js, "cdr3.beta", "cdr3fix.beta", "v.beta", "j.beta")
+    write_stats([a_updates, b_updates], "../tmp/stats.full.txt")
 
-    full_db.to_csv('../database/vdjdb.txt', sep="\t", index=False, quoting=csv.QUOTE_NONE)
+    print("-- processing the vdjdb.txt table")
+    ab_js = realign_all(json2tuples2(db, "cdr3"), segments_index)
 
+    print("-- writing")
+    db, ab_updates = update_segments(db, ab_js, "cdr3", "cdr3fix", "v.segm", "j.segm")
+    write_stats([ab_updates], "../tmp/stats.txt")
 
-	print("-- processing the vdjdb.txt table")
-	ab_js = json2tuples2(db, "cdr3")
-	ab_js = pool.map(fix_json, ab_js)
+    db["method"] = db["method"].apply(json.loads).apply(json.dumps, sort_keys=True)
+    db["meta"] = db["meta"].apply(json.loads).apply(json.dumps, sort_keys=True)
+    return full_db, db
 
-	print("-- writing")
-	stats = {}
-	for index, row in db.iterrows():
-		db = update_segments(index, row, ab_js[index], ".alpha" if row["gene"] == "TRA" else ".beta", True, stats, df=db)
-	with open("../tmp/stats.txt", "w") as file:
-		for s, v in sorted(stats.items(), key=lambda x: x[1], reverse=True):
-			print(s, v, sep="\t", file=file)
 
-	db["method"] = db["method"].apply(json.loads).apply(json.dumps, sort_keys=True)
-	db["meta"] = db["meta"].apply(json.loads).apply(json.dumps, sort_keys=True)
-	db.to_csv('../database/vdjdb.txt', sep="\t", index=False, quoting=csv.QUOTE_NONE)
+def process_all(full_db, db):
+    full_db, db = realign_tables(full_db, db, load_germline_index("../res/segments.txt"))
+    full_db.to_csv('../database/vdjdb_full.txt', sep="\t", index=False, quoting=csv.QUOTE_NONE)
+    db.to_csv('../database/vdjdb.txt', sep="\t", index=False, quoting=csv.QUOTE_NONE)
 
 
 if __name__ == "__main__":
@@ -296,44 +406,7 @@ if __name__ == "__main__":
     table = sys.argv[2]
     segments_filepath = sys.argv[3]
 
-    segments = pd.read_csv(segments_filepath, sep="\t")
-    segments.columns = ["species", "gene", "segment", "id", "ref", "seq"]
-
-    pool = mp.Pool(mp.cpu_count())
-    # pool = mp.Pool(1)
-
-    print("-- processing the vdjdb_full.txt table")
-    df = pd.read_csv(full_table, sep="\t")
-    a_js = json2tuples(df, "cdr3.alpha", "TRA")
-    b_js = json2tuples(df, "cdr3.beta", "TRB")
-    a_js = pool.map(fix_json, a_js)
-    b_js = pool.map(fix_json, b_js)
-
-    print("-- writing")
-    stats = {}
-    for index, row in df.iterrows():
-        update_segments(index, row, a_js[index], ".alpha", False, stats)
-        update_segments(index, row, b_js[index], ".beta", False, stats)
-    with open("../tmp/stats.full.txt", "w") as file:
-        for s, v in sorted(stats.items(), key=lambda x: x[1], reverse=True):
-            print(s, v, sep="\t", file=file)
-
-    df.to_csv(full_table, sep="\t", index=False, quoting=csv.QUOTE_NONE)
-
-    print("-- processing the vdjdb.txt table")
-    df = pd.read_csv(table, sep="\t")
-    ab_js = json2tuples2(df, "cdr3")
-    ab_js = pool.map(fix_json, ab_js)
-
-    print("-- writing")
-    stats = {}
-    for index, row in df.iterrows():
-        update_segments(index, row, ab_js[index], ".alpha" if row["gene"] == "TRA" else ".beta", True, stats)
-    with open("../tmp/stats.txt", "w") as file:
-        for s, v in sorted(stats.items(), key=lambda x: x[1], reverse=True):
-            print(s, v, sep="\t", file=file)
-
-    df["method"] = df["method"].apply(json.loads).apply(json.dumps, sort_keys=True)
-    df["meta"] = df["meta"].apply(json.loads).apply(json.dumps, sort_keys=True)
-
+    full_df, df = realign_tables(pd.read_csv(full_table, sep="\t"), pd.read_csv(table, sep="\t"),
+                                 load_germline_index(segments_filepath))
+    full_df.to_csv(full_table, sep="\t", index=False, quoting=csv.QUOTE_NONE)
     df.to_csv(table, sep="\t", index=False, quoting=csv.QUOTE_NONE)
@@ -0,0 +1,155 @@
+import os
+import hashlib
+import sqlite3
+import pandas as pd
+
+from typing import Optional, Tuple, Iterable
+
+from Utils import hash_file
+
+# bump when chunk processing logic changes so that stale frames are not reused
+CACHE_VERSION = "4"
+
+CACHE_DEPENDENCY_FILES = [
+    "../res/segments.txt",
+    "../res/segments.aaparts.txt",
+]
+
+CACHE_DEPENDENCY_DIRS = [
+    "../patches/",
+]
+
+
+def get_dependency_files() -> list:
+    """
+    :return: sorted list of files every processed chunk depends on
+    """
+    dependency_files = list(CACHE_DEPENDENCY_FILES)
+    for dependency_dir in CACHE_DEPENDENCY_DIRS:
+        dependency_files += [os.path.join(dependency_dir, file_name) for file_name in sorted(os.listdir(dependency_dir))
+                             if not file_name.startswith(".")]
+    return dependency_files
+
+
+class ChunkCache:
+    """
+    Persistent on-disk cache of QC-ed and fixed chunk frames keyed by chunk content hash
+    """
+    def __init__(self, cache_dir: str, dependency_files: list = None):
+        """
+        :param cache_dir: folder to store cached chunks in
+        :param dependency_files: files invalidating the whole cache when changed
+        """
+        self.cache_dir = cache_dir
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+        dependency_hash = hashlib.sha256(CACHE_VERSION.encode("utf-8"))
+        for dependency_file in (dependency_files if dependency_files is not None else get_dependency_files()):
+            dependency_hash.update(hash_file(dependency_file).encode("utf-8"))
+        self.dependency_hash = dependency_hash.hexdigest()
+
+    def _get_cache_file_name(self, chunk_file_name: str) -> str:
+        """
+        :param chunk_file_name: path to the chunk
+        :return: path to the cached frame of the current chunk version
+        """
+        chunk_hash = hashlib.sha256((hash_file(chunk_file_name) + self.dependency_hash).encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, f"{os.path.basename(chunk_file_name)}.{chunk_hash}.pkl")
+
+    def load(self, chunk_file_name: str) -> Optional[Tuple[pd.DataFrame, dict]]:
+        """
+        :param chunk_file_name: path to the chunk
+        :return: cached chunk frame and QC error messages or None if chunk is not cached
+        """
+        cache_file_name = self._get_cache_file_name(chunk_file_name)
+        if not os.path.exists(cache_file_name):
+            self.misses += 1
+            return None
+        cached = pd.read_pickle(cache_file_name)
+        self.hits += 1
+        return cached["chunk"], cached["errors"]
+
+    def store(self, chunk_file_name: str, chunk_df: pd.DataFrame, error_messages: dict) -> None:
+        """
+        Stores processed chunk and drops cached frames of its previous versions
+        :param chunk_file_name: path to the chunk
+        :param chunk_df: processed chunk frame
+        :param error_messages: QC error messages of the chunk
+        """
+        cache_file_name = self._get_cache_file_name(chunk_file_name)
+        chunk_prefix = f"{os.path.basename(chunk_file_name)}."
+        for file_name in os.listdir(self.cache_dir):
+            if file_name.startswith(chunk_prefix) and file_name.endswith(".pkl"):
+                os.remove(os.path.join(self.cache_dir, file_name))
+
+        tmp_file_name = f"{cache_file_name}.tmp"
+        pd.to_pickle({"chunk": chunk_df, "errors": dict(error_messages)}, tmp_file_name)
+        os.replace(tmp_file_name, cache_file_name)
+
+    def get_stats(self) -> str:
+        """
+        :return: hit/miss summary string
+        """
+        return f"{self.hits} hits, {self.misses} misses"
+
+
+class PgenCache:
+    """
+    Persistent sqlite cache of log10 Pgen values keyed by model name, model files hash and cdr3aa
+    """
+    # max number of sqlite query parameters
+    QUERY_BATCH_SIZE = 900
+
+    def __init__(self, cache_file_name: str):
+        """
+        :param cache_file_name: sqlite database file, created if missing
+        """
+        self.cache_file_name = cache_file_name
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(os.path.dirname(cache_file_name) or ".", exist_ok=True)
+        self.connection = sqlite3.connect(cache_file_name)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS pgen ("
+                                "model TEXT, model_hash TEXT, cdr3aa TEXT, log10_pgen REAL, "
+                                "PRIMARY KEY (model, model_hash, cdr3aa)) WITHOUT ROWID")
+
+    def get_many(self, model_name: str, model_hash: str, cdr3s: Iterable[str]) -> dict:
+        """
+        :param model_name: name of the OLGA model
+        :param model_hash: hash of the OLGA model files
+        :param cdr3s: cdr3 amino acid sequences
+        :return: dict of log10 Pgen by cdr3 for the cached sequences
+        """
+        cdr3s = list(set(cdr3s))
+        found = {}
+        for i in range(0, len(cdr3s), self.QUERY_BATCH_SIZE):
+            batch = cdr3s[i:i + self.QUERY_BATCH_SIZE]
+            found.update(self.connection.execute(
+                f"SELECT cdr3aa, log10_pgen FROM pgen WHERE model = ? AND model_hash = ? "
+                f"AND cdr3aa IN ({', '.join('?' * len(batch))})", [model_name, model_hash] + batch))
+        self.hits += len(found)
+        self.misses += len(cdr3s) - len(found)
+        return found
+
+    def put_many(self, model_name: str, model_hash: str, pgens: dict) -> None:
+        """
+        :param model_name: name of the OLGA model
+        :param model_hash: hash of the OLGA model files
+        :param pgens: dict of log10 Pgen by cdr3
+        """
+        with self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO pgen VALUES (?, ?, ?, ?)",
+                                        [(model_name, model_hash, cdr3, float(log10_pgen))
+                                         for cdr3, log10_pgen in pgens.items()])
+
+    def get_stats(self) -> str:
+        """
+        :return: hit/miss summary string
+        """
+        total = self.hits + self.misses
+        return f"{self.hits} hits, {self.misses} misses ({self.hits / total if total else 0:.1%} hit rate)"
+
+    def close(self) -> None:
+        self.connection.close()
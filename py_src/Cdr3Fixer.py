@@ -1,38 +1,125 @@
 from FixerDataModels import *
 from KmerScanner import KmerScanner
-from Utils import translate_linear, simplify_segment_name
+from Utils import translate_linear, simplify_segment_name, hash_file, LRUCache
 
+import os
+import hashlib
+import numpy as np
 import pandas as pd
 
 from collections import defaultdict
+from functools import wraps
+from multiprocessing import Pool
 from typing import Tuple, Optional, Any
 
+NOMENCLATURE_CONVERSIONS_FILE_NAME = "../patches/nomenclature.conversions"
+
+MEMOIZED_METHODS = ["fix_both", "fix", "guess_id", "get_closest_id"]
+
+# bump when fixing or segment name resolution logic changes so that saved fixer caches are not reused
+FIXER_CACHE_VERSION = "3"
+
+# FixerResult fields in the order of FixerResult.results_to_dict
+FIXER_RESULT_COLUMNS = ["cdr3", "cdr3_old", "fixNeeded", "good", "jCanonical", "jFixType", "jId", "jStart",
+                        "vCanonical", "vEnd", "vFixType", "vId"]
+
+# Cdr3Fixer of the fix_many pool worker process
+_worker_fixer = None
+
+
+def memoized(method):
+    """
+    Caches results of Cdr3Fixer method in the instance LRU cache keyed by positional arguments
+    """
+    @wraps(method)
+    def wrapper(self, *args):
+        cache = self.caches[method.__name__]
+        result = cache.get(args)
+        if result is LRUCache.MISSING:
+            result = method(self, *args)
+            cache.put(args, result)
+        return result
+    return wrapper
+
 
 class Cdr3Fixer:
     """
     Class for fixing row in chunk
     """
     def __init__(self, segments_file_name: str, segments_seq_file_name: str,
-                 max_replace_size: int = 1, min_hit_size: int = 2):
+                 max_replace_size: int = 1, min_hit_size: int = 2,
+                 cache_size: Optional[int] = 1 << 18, cache_file_name: Optional[str] = None):
         """
         :param segments_file_name: file with complete segment sequences
         :param segments_seq_file_name: file with parts of segments sequences
         :param max_replace_size: max replace size for matching hits with segments
         :param min_hit_size: min hit size with the segment
+        :param cache_size: max number of memoized results per method, None for unbounded, 0 to disable
+        :param cache_file_name: file to load memoized results from, if it was saved for the same inputs
         """
+        self.init_args = (segments_file_name, segments_seq_file_name, max_replace_size, min_hit_size)
         self.segments_by_id_by_species = defaultdict(dict)
-        self.segments_by_sequence_part_by_species_gene = defaultdict(dict)
+        self.segment_tries_by_species_gene = defaultdict(dict)
         self.max_replace_size = max_replace_size
         self.min_hit_size = min_hit_size
 
         self._load_segments_data(segments_file_name)
         self._load_segments_sequence_data(segments_seq_file_name)
-        self.nomenclature_conversions = pd.read_csv("../patches/nomenclature.conversions",
+        self.nomenclature_conversions = pd.read_csv(NOMENCLATURE_CONVERSIONS_FILE_NAME,
                                                                 sep='\t',
                                                                 index_col=0,
                                                                 header=None,
                                                                 skiprows=1
                                                                 )[1].to_dict() #rewrite it
+        self._build_resolution_index()
+
+        self.scanners = {}
+        self.scanners_built = 0
+        self.scanners_used = 0
+
+        self.caches = {method_name: LRUCache(cache_size) for method_name in MEMOIZED_METHODS}
+        fingerprint = hashlib.sha256(f"{FIXER_CACHE_VERSION}:{max_replace_size}:{min_hit_size}".encode("utf-8"))
+        for file_name in [segments_file_name, segments_seq_file_name, NOMENCLATURE_CONVERSIONS_FILE_NAME]:
+            fingerprint.update(hash_file(file_name).encode("utf-8"))
+        self.fingerprint = fingerprint.hexdigest()
+        if cache_file_name and os.path.exists(cache_file_name):
+            self.load_cache(cache_file_name)
+
+    def load_cache(self, cache_file_name: str) -> bool:
+        """
+        loads memoized results saved by save_cache
+        :param cache_file_name: file with memoized results
+        :return: True if results were loaded, False if they were saved for other inputs
+        """
+        saved_cache = pd.read_pickle(cache_file_name)
+        if saved_cache["fingerprint"] != self.fingerprint:
+            return False
+        for method_name, items in saved_cache["caches"].items():
+            for key, value in items:
+                self.caches[method_name].put(key, value)
+        return True
+
+    def save_cache(self, cache_file_name: str) -> None:
+        """
+        saves memoized results to be reused by next builds
+        :param cache_file_name: file to write memoized results to
+        """
+        pd.to_pickle({
+            "fingerprint": self.fingerprint,
+            "caches": {method_name: list(cache.data.items()) for method_name, cache in self.caches.items()}
+        }, cache_file_name)
+
+    def get_scanner_stats(self) -> dict:
+        """
+        :return: dict with numbers of built and used KmerScanners
+        """
+        return {"built": self.scanners_built, "used": self.scanners_used}
+
+    def cache_info(self) -> dict:
+        """
+        :return: dict with hit/miss/eviction counters for every memoized method
+        """
+        return {method_name: cache.get_stats() for method_name, cache in self.caches.items()}
 
     def _load_segments_data(self, segments_file_name: str) -> None:
         """
@@ -40,6 +127,8 @@ class Cdr3Fixer:
         :param segments_file_name: file with complete segment sequences
         """
         segments_file = pd.read_csv(segments_file_name, sep='\t')
+        # loaded germlines are shared with the stage II realignment
+        self.segments = segments_file.copy()
         for columns in ['#species', 'segment']:
             segments_file[columns] = segments_file[columns].apply(lambda x: x.lower())
 
@@ -55,14 +144,56 @@ class Cdr3Fixer:
 
     def _load_segments_sequence_data(self, segments_seq_file_name: str) -> None:
         """
-        loads and preprocesses parts of segment sequences
+        loads parts of segments sequences into prefix tries of V parts and suffix tries of J parts
         :param segments_seq_file_name: file with parts of segments sequences
         """
         segments_seq_file = pd.read_csv(segments_seq_file_name, sep='\t')
-        for _, segment in segments_seq_file.iterrows():
-            species_chain = segment.species + (".alpha" if segment.gene == "TRA" else ".beta")
-            self.segments_by_sequence_part_by_species_gene[species_chain][segment.cdr3] = segment.segm
+        for species, gene, cdr3_part, segment_type, segment_id in segments_seq_file[
+                ["species", "gene", "cdr3", "type", "segm"]].itertuples(index=False):
+            species_chain = species + (".alpha" if gene == "TRA" else ".beta")
+            five_prime = segment_type == "V"
+            node = self.segment_tries_by_species_gene[(species_chain, five_prime)]
+            for symbol in (cdr3_part if five_prime else reversed(cdr3_part)):
+                node = node.setdefault(symbol, {})
+            node[None] = segment_id
+
+    def _build_resolution_index(self) -> None:
+        """
+        Builds map of every segment name alias resolved by get_closest_id to the canonical segment id.
+        Candidate ids of the alias are tried in order alias, alias*01, alias-1*01 ... alias-100*01.
+        Only real segment ids are indexed, nomenclature conversions are applied by get_closest_id
+        """
+        self.resolution_index_by_species = {}
+        for species, segments_by_id in self.segments_by_id_by_species.items():
+            best_candidates = {}
+            for segment_id in segments_by_id.keys():
+                candidates = [(segment_id, 0)]
+                if segment_id.endswith("*01"):
+                    no_allele = segment_id[:-3]
+                    candidates.append((no_allele, 1))
+                    family, _, number = no_allele.rpartition("-")
+                    if family and number.isdigit() and str(int(number)) == number and 1 <= int(number) <= 100:
+                        candidates.append((family, 1 + int(number)))
+                for alias, priority in candidates:
+                    if alias not in best_candidates or priority < best_candidates[alias][0]:
+                        best_candidates[alias] = (priority, segment_id)
+            self.resolution_index_by_species[species] = {alias: segment_id
+                                                         for alias, (_, segment_id) in best_candidates.items()}
+
+    @staticmethod
+    def _resolve(resolution_index: dict, segment_id: str) -> str:
+        """
+        :param resolution_index: map of aliases to canonical ids of the species
+        :param segment_id: id of the gene being analyzed
+        :return: canonical id of the segment id or its simplified versions, unchanged id if not found
+        """
+        for id_variant in [segment_id, *simplify_segment_name(segment_id)]:
+            closest_id = resolution_index.get(id_variant)
+            if closest_id is not None:
+                return closest_id
+        return segment_id
 
+    @memoized
     def get_closest_id(self, species: str, segment_id: str) -> str:
         """
         Gets closet name of the segment
@@ -70,21 +201,28 @@ class Cdr3Fixer:
         :param segment_id: id of the gene being analyzed
         :return: possible conventional id or unchanged id
         """
-        segments_by_id = self.segments_by_id_by_species[species.lower()]
+        species_key = species.lower()
 
-        if species.lower() == "homosapiens":
+        # nomenclature conversions replace the exact id only, the result is resolved as usual
+        if species_key == "homosapiens":
             conversion = self.nomenclature_conversions.get(segment_id)
-            if conversion:
+            if isinstance(conversion, str) and conversion:
                 segment_id = conversion
 
-        if not segments_by_id:
+        resolution_index = self.resolution_index_by_species.get(species_key)
+        if not resolution_index:
             return segment_id
+        return self._resolve(resolution_index, segment_id)
 
-        for id_variant in [segment_id, *simplify_segment_name(segment_id)]:
-            for possible_variant in [id_variant, f"{id_variant}*01", *[f"{id_variant}-{i}*01" for i in range(1, 101)]]:
-                if possible_variant in segments_by_id.keys():
-                    return possible_variant
-        return segment_id
+    def dump_resolution_index(self, file_name: str) -> None:
+        """
+        Writes segment name resolution decisions for auditing
+        :param file_name: tsv file with species, alias and resolved segment id columns
+        """
+        pd.DataFrame([(species, alias, segment_id)
+                      for species, resolution_index in sorted(self.resolution_index_by_species.items())
+                      for alias, segment_id in sorted(resolution_index.items())],
+                     columns=["species", "alias", "segment.id"]).to_csv(file_name, sep="\t", index=False)
 
     def get_segment_seq(self, species: str, segment_id: str) -> Optional[str]:
         """
@@ -100,6 +238,25 @@ class Cdr3Fixer:
 
         return segments_by_id.get(segment_id)
 
+    def get_scanner(self, species: str, segment_id: str, five_prime: bool) -> KmerScanner:
+        """
+        Gets KmerScanner of the segment building it on first use
+        :param species: species of the TCR carrier
+        :param segment_id: id of the gene being analyzed
+        :param five_prime: scanner for the sequence from 5 prime, reversed sequence otherwise
+        :return: KmerScanner of the segment sequence
+        """
+        scanner_key = (species.lower(), segment_id, five_prime)
+        scanner = self.scanners.get(scanner_key)
+        if scanner is None:
+            segment_seq = self.get_segment_seq(species, segment_id)
+            scanner = KmerScanner(segment_seq if five_prime else segment_seq[::-1], self.min_hit_size)
+            self.scanners[scanner_key] = scanner
+            self.scanners_built += 1
+        self.scanners_used += 1
+        return scanner
+
+    @memoized
     def fix(self, cdr3: str, segment_id: str, species: str, five_prime: bool) -> OneSideFixerResult:
         """
         fixing cdr3 according to segment sequence
@@ -120,7 +277,7 @@ class Cdr3Fixer:
             cdr3 = cdr3[::-1]
             segment_seq = segment_seq[::-1]
 
-        scanner = KmerScanner(segment_seq, self.min_hit_size)
+        scanner = self.get_scanner(species, closest_id, five_prime)
 
         hit = scanner.scan(cdr3)
 
@@ -151,35 +308,53 @@ class Cdr3Fixer:
         else:
             return OneSideFixerResult(cdr3, closest_id, FailedNoAlignment)
 
+    @memoized
     def guess_id(self, cdr3: str, species: str, gene: str, five_prime: bool) -> str:
         """
-        Guesses gene id by part of the aa sequence
+        Guesses gene id by the longest germline part matching the start (V) or the end (J) of cdr3.
+        V parts of 2 to len(cdr3) - 4 and J parts of 4 to len(cdr3) - 2 amino acids are considered
         :param cdr3: cdr3's amino acid sequence
         :param species: species of the TCR carrier
         :param gene: "alpha" or "beta"
         :param five_prime: sequence from 5 prime
         :return: guessed id or empty string
         """
-        species_gene = f"{species}.{gene}"
-        segment_seq_map = self.segments_by_sequence_part_by_species_gene.get(species_gene)
+        node = self.segment_tries_by_species_gene.get((f"{species}.{gene}", five_prime))
 
-        if not segment_seq_map:
+        if not node:
             return ""
 
         if five_prime:
-            for i in range(len(cdr3) - 4, 1, -1):
-                res = segment_seq_map.get(cdr3[:i])
-                if res:
-                    return res
-                return ""
+            min_part_size, max_part_size, step, pos = 2, len(cdr3) - 4, 1, 0
         else:
-            for i in range(2, len(cdr3) - 3):
-                res = segment_seq_map.get(cdr3[i:])
-                if res:
-                    return res
-            else:
-                return ""
+            min_part_size, max_part_size, step, pos = 4, len(cdr3) - 2, -1, len(cdr3) - 1
 
+        guessed_id = ""
+        for part_size in range(1, max_part_size + 1):
+            node = node.get(cdr3[pos])
+            if node is None:
+                break
+            if part_size >= min_part_size and None in node:
+                guessed_id = node[None]
+            pos += step
+        return guessed_id
+
+    def guess_ids(self, cdr3s: pd.Series, species: Any, gene: str, five_prime: bool) -> pd.Series:
+        """
+        Guesses gene ids for a column of cdr3 sequences, each unique cdr3 is guessed once
+        :param cdr3s: cdr3's amino acid sequences
+        :param species: species of the TCR carriers, single value or Series aligned with cdr3s
+        :param gene: "alpha" or "beta"
+        :param five_prime: sequence from 5 prime
+        :return: Series of guessed ids or empty strings aligned with cdr3s
+        """
+        keys = pd.DataFrame({"cdr3": cdr3s, "species": species}, index=cdr3s.index)
+        codes, unique_keys = pd.MultiIndex.from_frame(keys).factorize()
+        guessed_ids = np.array([self.guess_id(cdr3, key_species, gene, five_prime)
+                                for cdr3, key_species in unique_keys], dtype=object)
+        return pd.Series(guessed_ids[codes], index=cdr3s.index, dtype=object)
+
+    @memoized
     def fix_both(self, cdr3: str, v_id: str, j_id: str, species: str):
         """
         Fixes V and J segments of cdr3
@@ -207,3 +382,103 @@ class Cdr3Fixer:
             j_result.segmentId, j_result.FixType
         )
 
+    def fix_many(self, frame: pd.DataFrame, chain: str, jobs: int = 1, shard_size: int = 4096) -> pd.DataFrame:
+        """
+        Fixes cdr3 of the chain for all rows of the frame, each unique (cdr3, v, j, species) is fixed once
+        :param frame: DataFrame with non-null cdr3.{chain} and v.{chain}, j.{chain}, species columns
+        :param chain: "alpha" or "beta"
+        :param jobs: number of worker processes, unique inputs are fixed in this process if 1
+        :param shard_size: number of unique inputs sent to a worker per task
+        :return: DataFrame of FixerResult fields aligned with frame
+        """
+        if not len(frame):
+            return pd.DataFrame(columns=FIXER_RESULT_COLUMNS, index=frame.index)
+
+        codes, unique_keys = pd.MultiIndex.from_frame(
+            frame[[f"cdr3.{chain}", f"v.{chain}", f"j.{chain}", "species"]]).factorize()
+        unique_keys = list(unique_keys)
+
+        if jobs > 1 and len(unique_keys) > shard_size:
+            # memoized results are looked up here, only the misses are fixed by workers and stored back
+            fix_both_cache = self.caches["fix_both"]
+            results = [fix_both_cache.get(key) for key in unique_keys]
+            missing_keys = [key for key, result in zip(unique_keys, results) if result is LRUCache.MISSING]
+            if missing_keys:
+                shards = [missing_keys[i:i + shard_size] for i in range(0, len(missing_keys), shard_size)]
+                with Pool(min(jobs, len(shards)), initializer=_init_fix_worker, initargs=self.init_args) as pool:
+                    fixed_results = []
+                    # scanners are built and used by the workers, their counters are added to this fixer
+                    for shard_results, scanners_built, scanners_used in pool.imap(_fix_shard, shards):
+                        fixed_results += shard_results
+                        self.scanners_built += scanners_built
+                        self.scanners_used += scanners_used
+                fixed_results = iter(fixed_results)
+                for i, key in enumerate(unique_keys):
+                    if results[i] is LRUCache.MISSING:
+                        results[i] = next(fixed_results)
+                        fix_both_cache.put(key, results[i])
+        else:
+            results = [self.fix_both(*key) for key in unique_keys]
+
+        fixed = pd.DataFrame([result.results_to_dict() for result in results], columns=FIXER_RESULT_COLUMNS).iloc[codes]
+        fixed.index = frame.index
+        return fixed
+
+
+def _init_fix_worker(*init_args) -> None:
+    """
+    Loads segment tables once per fix_many worker process
+    """
+    global _worker_fixer
+    _worker_fixer = Cdr3Fixer(*init_args)
+
+
+def _fix_shard(keys: list) -> Tuple[list, int, int]:
+    """
+    :param keys: list of (cdr3, v, j, species) tuples
+    :return: list of FixerResults, numbers of KmerScanners built and used for the shard
+    """
+    scanner_stats = _worker_fixer.get_scanner_stats()
+    results = [_worker_fixer.fix_both(*key) for key in keys]
+    return (results,
+            _worker_fixer.scanners_built - scanner_stats["built"],
+            _worker_fixer.scanners_used - scanner_stats["used"])
+
+
+if __name__ == "__main__":
+    # equivalence check of segment name resolution against the candidate scan get_closest_id was implemented with
+    import glob
+
+    def get_closest_id_by_scan(fixer, species, segment_id):
+        segments_by_id = fixer.segments_by_id_by_species.get(species.lower(), {})
+        if species.lower() == "homosapiens":
+            conversion = fixer.nomenclature_conversions.get(segment_id)
+            if conversion:
+                segment_id = conversion
+        if not segments_by_id:
+            return segment_id
+        for id_variant in [segment_id, *simplify_segment_name(segment_id)]:
+            for possible_variant in [id_variant, f"{id_variant}*01", *[f"{id_variant}-{i}*01" for i in range(1, 101)]]:
+                if possible_variant in segments_by_id.keys():
+                    return possible_variant
+        return segment_id
+
+    fixer = Cdr3Fixer("../res/segments.txt", "../res/segments.aaparts.txt", cache_size=0)
+    known_ids = {segment_id for segments_by_id in fixer.segments_by_id_by_species.values()
+                 for segment_id in segments_by_id}
+    known_ids |= {str(segment_id) for conversion in fixer.nomenclature_conversions.items() for segment_id in conversion}
+    for chunk_file in glob.glob("../chunks/*.txt"):
+        chunk = pd.read_csv(chunk_file, sep="\t", usecols=lambda col: col in ["v.alpha", "j.alpha", "v.beta", "j.beta"],
+                            dtype=str)
+        known_ids |= {segment_id for column in chunk.columns for ids in chunk[column].dropna()
+                      for segment_id in ids.split(",")}
+    known_ids |= {id_variant for segment_id in list(known_ids) for id_variant in simplify_segment_name(segment_id)}
+    # allele and subgroup suffixes are simplified away, so decorated ids are resolved through their aliases
+    known_ids |= {f"{segment_id}{suffix}" for segment_id in list(known_ids) for suffix in ["*01", "*02", "-1", "-1*01"]}
+
+    species_list = list(pd.read_csv("../res/segments.txt", sep="\t")["#species"].unique()) + ["UnknownSpecies"]
+    for species in species_list:
+        for segment_id in known_ids:
+            expected = get_closest_id_by_scan(fixer, species, segment_id)
+            assert fixer.get_closest_id(species, segment_id) == expected, (species, segment_id, expected)
+    print(f"get_closest_id matches candidate scan on {len(known_ids)} ids of {len(species_list)} species")
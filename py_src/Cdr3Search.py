@@ -0,0 +1,425 @@
+import os
+import sys
+import argparse
+import itertools
+import warnings
+import numpy as np
+import pandas as pd
+
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Optional
+
+from Utils import hash_file
+from VdjdbLoader import VdjdbRelease
+
+# columns of vdjdb.txt kept in the index and reported for found entries
+RECORD_COLUMNS = ["complex.id", "gene", "cdr3", "v.segm", "j.segm", "species", "mhc.a", "mhc.b", "mhc.class",
+                  "antigen.epitope", "antigen.gene", "antigen.species", "reference.id", "vdjdb.score"]
+
+INDEX_FILE_NAME = "vdjdb.cdr3index.pkl"
+
+# bump when index layout or variant hashing changes so that stale indices are rebuilt
+INDEX_VERSION = "2"
+
+# odd multiplier of the polynomial variant hash, collisions only add candidates checked by distance
+HASH_BASE = 0x9E3779B97F4A7C15
+
+METRICS = ["hamming", "levenshtein"]
+
+
+@lru_cache(maxsize=None)
+def get_kept_positions(length: int, deletions: int) -> np.ndarray:
+    """
+    :param length: sequence length
+    :param deletions: number of deleted symbols
+    :return: matrix of symbol positions kept by every combination of deletions, one row per combination
+    """
+    combinations = list(itertools.combinations(range(length), length - deletions))
+    return np.array(combinations, dtype=np.intp).reshape(len(combinations), length - deletions)
+
+
+@lru_cache(maxsize=None)
+def get_hash_powers(length: int) -> np.ndarray:
+    """
+    :param length: max variant length
+    :return: powers of HASH_BASE modulo 2^64
+    """
+    return np.array([pow(HASH_BASE, i, 2 ** 64) for i in range(length)], dtype=np.uint64)
+
+
+def encode_sequences(seqs: list, length: int) -> np.ndarray:
+    """
+    :param seqs: amino acid sequences of the same length
+    :param length: length of the sequences
+    :return: matrix of sequence symbol codes, one row per sequence
+    """
+    return np.frombuffer("".join(seqs).encode("ascii"), dtype=np.uint8).reshape(len(seqs), length)
+
+
+def hash_deletion_variants(codes: np.ndarray, max_deletions: int) -> np.ndarray:
+    """
+    :param codes: matrix of symbol codes of sequences of the same length
+    :param max_deletions: max number of deleted symbols
+    :return: matrix of hashes of sequences obtained by deleting up to max_deletions symbols,
+    including the sequence itself, one row per sequence
+    """
+    length = codes.shape[1]
+    hashes = []
+    for deletions in range(min(max_deletions, length) + 1):
+        variants = codes[:, get_kept_positions(length, deletions)].astype(np.uint64)
+        hashes.append((variants * get_hash_powers(length - deletions)).sum(axis=2, dtype=np.uint64))
+    return np.concatenate(hashes, axis=1)
+
+
+def hamming_distances(query_codes: np.ndarray, codes: np.ndarray, lengths: np.ndarray,
+                      max_distance: int) -> np.ndarray:
+    """
+    :param query_codes: symbol codes of the query
+    :param codes: padded matrix of symbol codes of the candidates, all of the query length
+    :param lengths: lengths of the candidates
+    :param max_distance: max distance of interest
+    :return: distances to the candidates
+    """
+    return (codes[:, :len(query_codes)] != query_codes).sum(axis=1)
+
+
+def levenshtein_distances(query_codes: np.ndarray, codes: np.ndarray, lengths: np.ndarray,
+                          max_distance: int) -> np.ndarray:
+    """
+    Banded dynamic programming over all candidates at once, cells further than max_distance from the diagonal
+    can not lead to a distance within max_distance and are not computed
+    :param query_codes: symbol codes of the query
+    :param codes: padded matrix of symbol codes of the candidates
+    :param lengths: lengths of the candidates
+    :param max_distance: max distance of interest
+    :return: distances to the candidates capped at max_distance + 1
+    """
+    out_of_band = max_distance + 1
+    width = min(codes.shape[1], len(query_codes) + max_distance)
+    # mismatches[i, j] are candidate symbols at position j differing from the query symbol i
+    mismatches = query_codes[:, None, None] != codes[:, :width].T
+    previous = np.tile(np.minimum(np.arange(width + 1), out_of_band)[:, None], (1, len(codes)))
+    for i in range(1, len(query_codes) + 1):
+        start, end = max(1, i - max_distance), min(width, i + max_distance)
+        current = np.full_like(previous, out_of_band)
+        current[0] = min(i, out_of_band)
+        current[start:end + 1] = np.minimum(previous[start:end + 1] + 1,
+                                            previous[start - 1:end] + mismatches[i - 1, start - 1:end])
+        # insertions chain along the row, min(current[j - s] + s) is propagated by doubling s
+        step = 1
+        while step <= end - start + 1:
+            current[start - 1 + step:end + 1] = np.minimum(current[start - 1 + step:end + 1],
+                                                           current[start - 1:end + 1 - step] + step)
+            step *= 2
+        previous = np.minimum(current, out_of_band)
+    return np.where(lengths <= width, previous[np.minimum(lengths, width), np.arange(len(codes))], out_of_band)
+
+
+DISTANCES = {
+    "hamming": hamming_distances,
+    "levenshtein": levenshtein_distances
+}
+
+
+def _get_segment_gene(segment) -> str:
+    """
+    :return: segment name without allele
+    """
+    return segment.split("*")[0] if isinstance(segment, str) else ""
+
+
+@dataclass
+class Cdr3Bucket:
+    """
+    Dataclass to store indexed sequences of a species and gene
+    """
+    seqs: np.ndarray
+    # padded matrix of sequence symbol codes and sequence lengths
+    codes: np.ndarray
+    lengths: np.ndarray
+    # records rows of every sequence, rows[row_offsets[i]:row_offsets[i + 1]] have sequence i
+    rows: np.ndarray
+    row_offsets: np.ndarray
+    # sorted deletion variant hashes and ids of the sequences they come from
+    variant_hashes: np.ndarray
+    variant_seq_ids: np.ndarray
+
+
+def build_bucket(seqs: np.ndarray, seq_ids: np.ndarray, rows: np.ndarray, max_distance: int) -> Cdr3Bucket:
+    """
+    :param seqs: unique sequences
+    :param seq_ids: sequence id of every row
+    :param rows: records rows
+    :param max_distance: max distance supported by queries
+    :return: indexed sequences
+    """
+    lengths = np.array([len(seq) for seq in seqs], dtype=np.int32)
+    codes = np.zeros((len(seqs), lengths.max()), dtype=np.uint8)
+    variant_hashes = []
+    variant_seq_ids = []
+    for length in np.unique(lengths):
+        length_seq_ids = np.flatnonzero(lengths == length)
+        length_codes = encode_sequences(list(seqs[length_seq_ids]), length)
+        codes[length_seq_ids, :length] = length_codes
+        hashes = hash_deletion_variants(length_codes, max_distance)
+        variant_hashes.append(hashes.ravel())
+        variant_seq_ids.append(np.repeat(length_seq_ids, hashes.shape[1]).astype(np.int32))
+    variant_hashes = np.concatenate(variant_hashes)
+    variant_seq_ids = np.concatenate(variant_seq_ids)
+
+    # same variant is produced by different deletions of repeated symbols
+    order = np.lexsort((variant_seq_ids, variant_hashes))
+    variant_hashes = variant_hashes[order]
+    variant_seq_ids = variant_seq_ids[order]
+    is_first = np.ones(len(order), dtype=bool)
+    is_first[1:] = (variant_hashes[1:] != variant_hashes[:-1]) | (variant_seq_ids[1:] != variant_seq_ids[:-1])
+
+    return Cdr3Bucket(seqs=seqs, codes=codes, lengths=lengths,
+                      rows=rows[np.argsort(seq_ids, kind="stable")],
+                      row_offsets=np.concatenate([[0], np.cumsum(np.bincount(seq_ids, minlength=len(seqs)))]),
+                      variant_hashes=variant_hashes[is_first], variant_seq_ids=variant_seq_ids[is_first])
+
+
+class Cdr3SearchIndex:
+    """
+    Deletion neighbourhood index of vdjdb.txt CDR3 sequences by species and gene. Two sequences within
+    Levenshtein (and thus Hamming) distance k share a variant with at most k deletions, so only entries
+    sharing a deletion variant with the query are compared to it
+    """
+    def __init__(self, records: pd.DataFrame, max_distance: int = 2, source_hash: Optional[str] = None,
+                 buckets: Optional[dict] = None):
+        """
+        :param records: vdjdb.txt table
+        :param max_distance: max distance supported by queries
+        :param source_hash: hash of the table file the index was built from
+        :param buckets: Cdr3Buckets by species and gene built for the records, built from the records if None
+        """
+        self.max_distance = max_distance
+        self.source_hash = source_hash
+        if buckets is None:
+            records = records.loc[records["cdr3"].notnull() & (records["cdr3"] != ""),
+                                  [col for col in RECORD_COLUMNS if col in records.columns]].reset_index(drop=True)
+            # dictionary encoded parquet columns are compared as plain strings
+            records = records.astype({col: object for col in records.columns
+                                      if isinstance(records[col].dtype, pd.CategoricalDtype)})
+        self.records = records
+        # segment genes without alleles and scores used by search filters
+        self.v_genes = self.records["v.segm"].map(_get_segment_gene).to_numpy(dtype=object)
+        self.j_genes = self.records["j.segm"].map(_get_segment_gene).to_numpy(dtype=object)
+        self.scores = self.records["vdjdb.score"].to_numpy()
+        if buckets is None:
+            buckets = {}
+            for (species, gene), bucket in self.records.groupby(["species", "gene"], sort=False):
+                seq_ids, seqs = pd.factorize(bucket["cdr3"])
+                buckets[(species, gene)] = build_bucket(np.asarray(seqs, dtype=object), seq_ids,
+                                                        bucket.index.to_numpy(), max_distance)
+        self.buckets = buckets
+
+    def find_sequences(self, cdr3: str, species: str, gene: str, max_distance: int = 1,
+                       metric: str = "levenshtein") -> list:
+        """
+        :param cdr3: query amino acid sequence
+        :param species: species of the entries
+        :param gene: TRA or TRB
+        :param max_distance: max distance to the query
+        :param metric: hamming or levenshtein
+        :return: list of (sequence id, sequence, distance) tuples of the species and gene bucket
+        """
+        if max_distance > self.max_distance:
+            raise ValueError(f"index supports distances up to {self.max_distance}, {max_distance} requested")
+        if metric not in DISTANCES:
+            raise ValueError(f"unknown metric {metric}, expected one of {METRICS}")
+        bucket = self.buckets.get((species, gene))
+        if bucket is None or not cdr3:
+            return []
+
+        query_codes = encode_sequences([cdr3], len(cdr3))
+        query_hashes = np.unique(hash_deletion_variants(query_codes, max_distance))
+        starts = np.searchsorted(bucket.variant_hashes, query_hashes, side="left")
+        counts = np.searchsorted(bucket.variant_hashes, query_hashes, side="right") - starts
+        positions = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+        candidate_ids = np.unique(bucket.variant_seq_ids[positions])
+        if metric == "hamming":
+            # sequences of other length share deletion variants with the query but have no hamming distance to it
+            candidate_ids = candidate_ids[bucket.lengths[candidate_ids] == len(cdr3)]
+        if not len(candidate_ids):
+            return []
+
+        distances = DISTANCES[metric](query_codes[0], bucket.codes[candidate_ids], bucket.lengths[candidate_ids],
+                                      max_distance)
+        is_found = distances <= max_distance
+        return [(seq_id, bucket.seqs[seq_id], int(distance))
+                for seq_id, distance in zip(candidate_ids[is_found], distances[is_found])]
+
+    def search(self, cdr3: str, species: str, gene: str, max_distance: int = 1, metric: str = "levenshtein",
+               v_segm: Optional[str] = None, j_segm: Optional[str] = None,
+               min_score: Optional[int] = None) -> pd.DataFrame:
+        """
+        Finds entries with CDR3 similar to the query
+        :param cdr3: query amino acid sequence
+        :param species: species of the entries
+        :param gene: TRA or TRB
+        :param max_distance: max distance to the query
+        :param metric: hamming or levenshtein
+        :param v_segm: V segment the entries should have, alleles are not compared
+        :param j_segm: J segment the entries should have, alleles are not compared
+        :param min_score: minimal vdjdb.score of the entries
+        :return: found vdjdb.txt entries with distance column, closest first
+        """
+        found = self.find_sequences(cdr3, species, gene, max_distance, metric)
+        if not found:
+            return self.records.iloc[:0].assign(distance=pd.Series(dtype=int))
+        bucket = self.buckets[(species, gene)]
+        found_rows = [bucket.rows[bucket.row_offsets[seq_id]:bucket.row_offsets[seq_id + 1]] for seq_id, _, _ in found]
+        distances = np.repeat([distance for _, _, distance in found], [len(seq_rows) for seq_rows in found_rows])
+        found_rows = np.concatenate(found_rows)
+
+        mask = np.ones(len(found_rows), dtype=bool)
+        if v_segm is not None:
+            mask &= self.v_genes[found_rows] == _get_segment_gene(v_segm)
+        if j_segm is not None:
+            mask &= self.j_genes[found_rows] == _get_segment_gene(j_segm)
+        if min_score is not None:
+            mask &= self.scores[found_rows] >= min_score
+        order = np.argsort(distances[mask], kind="stable")
+        result = self.records.take(found_rows[mask][order])
+        result["distance"] = distances[mask][order]
+        return result
+
+    def save(self, index_file_name: str) -> None:
+        """
+        Writes the index as plain arrays and the records frame, so that it does not depend on the module
+        the index classes were defined in when loaded
+        :param index_file_name: file to write the index to
+        """
+        tmp_file_name = f"{index_file_name}.tmp"
+        pd.to_pickle({
+            "version": INDEX_VERSION,
+            "max_distance": self.max_distance,
+            "source_hash": self.source_hash,
+            "records": self.records,
+            "buckets": {key: vars(bucket) for key, bucket in self.buckets.items()}
+        }, tmp_file_name)
+        os.replace(tmp_file_name, index_file_name)
+
+    @staticmethod
+    def load(index_file_name: str) -> "Cdr3SearchIndex":
+        """
+        :param index_file_name: file with the index written by save
+        :return: loaded index
+        """
+        saved_index = pd.read_pickle(index_file_name)
+        if not isinstance(saved_index, dict) or saved_index.get("version") != INDEX_VERSION:
+            raise ValueError(f"{index_file_name} was written by another index version")
+        return Cdr3SearchIndex(saved_index["records"], saved_index["max_distance"], saved_index["source_hash"],
+                               {key: Cdr3Bucket(**bucket) for key, bucket in saved_index["buckets"].items()})
+
+
+def load_release_index(release_dir: str = "../database/", max_distance: int = 2) -> Cdr3SearchIndex:
+    """
+    Loads index saved next to the release default table, rebuilds and saves it if it is missing, stale
+    or unreadable
+    :param release_dir: folder with the database tables
+    :param max_distance: max distance supported by the index
+    :return: CDR3 search index of the release
+    """
+    release = VdjdbRelease(release_dir)
+    index_file_name = os.path.join(release_dir, INDEX_FILE_NAME)
+    source_hash = hash_file(release.get_table_file("default"))
+    if os.path.exists(index_file_name):
+        try:
+            index = Cdr3SearchIndex.load(index_file_name)
+        except Exception as e:
+            warnings.warn(f"{index_file_name} can not be loaded, rebuilding it: {e}")
+        else:
+            if index.source_hash == source_hash and index.max_distance >= max_distance:
+                return index
+
+    records = release.load("default", columns=RECORD_COLUMNS).df
+    index = Cdr3SearchIndex(records, max_distance, source_hash)
+    index.save(index_file_name)
+    return index
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Search VDJdb for CDR3 sequences similar to the query ones")
+    parser.add_argument("cdr3", nargs="*", help="query CDR3 amino acid sequences")
+    parser.add_argument("--release-dir", default="../database/", type=str,
+                        help="folder with the database tables")
+    parser.add_argument("--species", default="HomoSapiens", type=str)
+    parser.add_argument("--gene", default="TRB", type=str)
+    parser.add_argument("--max-distance", default=1, type=int)
+    parser.add_argument("--metric", default="levenshtein", choices=METRICS)
+    parser.add_argument("--v-segm", default=None, type=str, help="V segment the entries should have")
+    parser.add_argument("--j-segm", default=None, type=str, help="J segment the entries should have")
+    parser.add_argument("--min-score", default=None, type=int, help="minimal vdjdb.score of the entries")
+    parser.add_argument("--check", action="store_true",
+                        help="check found sequences against brute force distances on random sequences and exit")
+    args = parser.parse_args()
+
+    if args.check:
+        # equivalence check against distances computed for every sequence of the bucket
+        import random
+
+        def hamming_by_scan(query, seq):
+            return sum(a != b for a, b in zip(query, seq)) if len(query) == len(seq) else None
+
+        def levenshtein_by_scan(query, seq):
+            previous = list(range(len(seq) + 1))
+            for i, a in enumerate(query, 1):
+                current = [i]
+                for j, b in enumerate(seq, 1):
+                    current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (a != b)))
+                previous = current
+            return previous[-1]
+
+        def find_by_scan(seqs, query, max_distance, metric):
+            if not query:
+                return {}
+            distance_function = hamming_by_scan if metric == "hamming" else levenshtein_by_scan
+            distances = {seq: distance_function(query, seq) for seq in seqs}
+            return {seq: distance for seq, distance in distances.items()
+                    if distance is not None and distance <= max_distance}
+
+        def make_index(seqs):
+            return Cdr3SearchIndex(pd.DataFrame({"cdr3": seqs, "species": "HomoSapiens", "gene": "TRB",
+                                                 "v.segm": "TRBV1*01", "j.segm": "TRBJ1-1*01", "vdjdb.score": 0}))
+
+        random.seed(42)
+        alphabet = "ACDEFGSW"
+        cases = [(["CASSLF"], "CASSLFA")]
+        for _ in range(50):
+            seqs = ["".join(random.choices(alphabet, k=random.randint(1, 16))) for _ in range(random.randint(1, 200))]
+            for _ in range(20):
+                query = list(random.choice(seqs))
+                for _ in range(random.randint(0, 3)):
+                    position = random.randint(0, len(query))
+                    operation = random.choice("sid")
+                    if operation == "i" or not query:
+                        query.insert(position, random.choice(alphabet))
+                    elif operation == "s":
+                        query[min(position, len(query) - 1)] = random.choice(alphabet)
+                    else:
+                        del query[min(position, len(query) - 1)]
+                cases.append((seqs, "".join(query)))
+        checked = 0
+        cdr3_index = None
+        for seqs, query in cases:
+            if cdr3_index is None or cdr3_index.records["cdr3"].tolist() != seqs:
+                cdr3_index = make_index(seqs)
+            for metric in METRICS:
+                for max_distance in range(cdr3_index.max_distance + 1):
+                    found = {seq: distance for _, seq, distance
+                             in cdr3_index.find_sequences(query, "HomoSapiens", "TRB", max_distance, metric)}
+                    expected = find_by_scan(seqs, query, max_distance, metric)
+                    assert found == expected, (seqs, query, max_distance, metric, found, expected)
+                    checked += 1
+        print(f"Cdr3SearchIndex matches brute force search in {checked} random checks")
+        sys.exit(0)
+
+    cdr3_index = load_release_index(args.release_dir, max(args.max_distance, 2))
+    found = [cdr3_index.search(query, args.species, args.gene, args.max_distance, args.metric, args.v_segm,
+                               args.j_segm, args.min_score).assign(query=query) for query in args.cdr3]
+    if found:
+        pd.concat(found).to_csv(sys.stdout, sep="\t", index=False)
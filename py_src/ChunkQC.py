@@ -1,6 +1,6 @@
 import re
+import numpy as np
 import pandas as pd
-from collections import defaultdict
 
 nomenclature_df = pd.read_csv('../patches/IGM_nomenclature_table.tsv', sep='\t')
 nomenclature_set = set(nomenclature_df['IMGT/GENE-DB'])
@@ -75,6 +75,10 @@ SIGNATURE_COLS = [
 
 speciesList = ["homosapiens", "musmusculus", "rattusnorvegicus", "macacamulatta"]
 
+AA_SEQ_PATTERN = re.compile(r'^[ARNDCQEGHILKMFPSTWYV]{4,}$')
+MHC_PATTERN = re.compile(r'^HLA-[A-Z]+[0-9]?\*\d{2}(:\d{2,3}){0,3}$')
+REFERENCE_PREFIXES = ('PMID:', 'doi:', 'http://', 'https://')
+
 
 def is_aa_seq_valid(aa_seq: str) -> bool:
     """
@@ -83,7 +87,7 @@ def is_aa_seq_valid(aa_seq: str) -> bool:
     """
     if pd.isnull(aa_seq):
         return True
-    return len(aa_seq) > 3 and bool(re.match(r'^[ARNDCQEGHILKMFPSTWYV]+$', aa_seq))
+    return bool(AA_SEQ_PATTERN.match(aa_seq))
 
 
 def is_MHC_valid(hla_allele: str) -> bool:
@@ -91,29 +95,99 @@ def is_MHC_valid(hla_allele: str) -> bool:
     :param hla_allele: HLA allele string
     :return: HLA is valid
     """
-    return bool(re.match(r'^HLA-[A-Z]+[0-9]?\*\d{2}(:\d{2,3}){0,3}$', hla_allele)) or hla_allele[0:3] != 'HLA'
+    return bool(MHC_PATTERN.match(hla_allele)) or hla_allele[0:3] != 'HLA'
+
+
+def _as_str(column: pd.Series) -> pd.Series:
+    """
+    :param column: chunk column
+    :return: column with all non-null values converted to str
+    """
+    return column.astype(object).where(column.isnull(), column.astype(str))
+
+
+def are_aa_seqs_valid(column: pd.Series) -> pd.Series:
+    """
+    :param column: amino acid sequences to be validated
+    :return: mask of valid or null sequences
+    """
+    return column.isnull() | column.str.match(AA_SEQ_PATTERN, na=False)
 
 
-# dict of validators to be applied to every chunk
+def are_MHCs_valid(column: pd.Series) -> pd.Series:
+    """
+    :param column: HLA allele strings
+    :return: mask of valid HLA alleles
+    """
+    return column.str.match(MHC_PATTERN, na=False) | (column.str[0:3] != 'HLA')
+
+
+def _starts_with_or_null(prefix):
+    return lambda column: column.isnull() | column.str.startswith(prefix, na=False)
+
+
+# dict of columnar validators to be applied to every chunk
 validators = {
-    "cdr3.alpha": is_aa_seq_valid,
-    "v.alpha": lambda x: x.startswith("TRAV") if not pd.isnull(x) else True,
-    'j.alpha': lambda x: x.startswith('TRAJ') if not pd.isnull(x) else True,
-    'cdr3.beta': is_aa_seq_valid,
-    "v.beta": lambda x: x.startswith('TRBV') if not pd.isnull(x) else True,
-    'd.beta': lambda x: x.startswith('TRBD') if not pd.isnull(x) else True,
-    'j.beta': lambda x: x.startswith('TRBJ') if not pd.isnull(x) else True,
-    'species': lambda x: x.lower() in speciesList,
-    'mhc.a': is_MHC_valid,
-    'mhc.b': is_MHC_valid,
-    'mhc.class': lambda x: x == 'MHCI' or x == 'MHCII',
-    'antigen.epitope': is_aa_seq_valid,
-    'antigen.gene': lambda x: pd.notnull(x),
-    'reference.id': lambda x: x.startswith('PMID:') or x.startswith('doi:') or x.startswith('http://')
-                              or x.startswith('https://') or 'unpublished' in x.lower() if not pd.isnull(x) else True
+    "cdr3.alpha": are_aa_seqs_valid,
+    "v.alpha": _starts_with_or_null("TRAV"),
+    'j.alpha': _starts_with_or_null('TRAJ'),
+    'cdr3.beta': are_aa_seqs_valid,
+    "v.beta": _starts_with_or_null('TRBV'),
+    'd.beta': _starts_with_or_null('TRBD'),
+    'j.beta': _starts_with_or_null('TRBJ'),
+    'species': lambda x: x.str.lower().isin(speciesList),
+    'mhc.a': are_MHCs_valid,
+    'mhc.b': are_MHCs_valid,
+    'mhc.class': lambda x: x.isin(['MHCI', 'MHCII']),
+    'antigen.epitope': are_aa_seqs_valid,
+    'antigen.gene': lambda x: x.notnull(),
+    'reference.id': lambda x: x.isnull() | x.str.startswith(REFERENCE_PREFIXES, na=False)
+                              | x.str.lower().str.contains('unpublished', regex=False, na=False)
 
 }
 
+# bit of the QC error mask for every error message, bits order defines messages order
+QC_ERROR_BITS = {message: 1 << bit for bit, message in enumerate(
+    ['duplicate'] + [f'bad {validating_column}' for validating_column in validators.keys()]
+    + ['no.cdr3', 'no.antigen.seq', 'no.mhc'])}
+
+
+def decode_qc_errors(error_mask: int) -> list:
+    """
+    :param error_mask: QC error bitmask of the row
+    :return: list of error messages
+    """
+    return [message for message, bit in QC_ERROR_BITS.items() if error_mask & bit]
+
+
+def encode_qc_errors(error_messages: dict) -> pd.Series:
+    """
+    :param error_messages: dict with indexes of broken rows as keys and lists of error messages as values
+    :return: QC error bitmask column of the broken rows
+    """
+    return pd.Series({row_ind: sum(QC_ERROR_BITS[message] for message in messages)
+                      for row_ind, messages in error_messages.items()}, dtype='int64')
+
+
+def get_error_messages(qc_errors: pd.Series) -> dict:
+    """
+    :param qc_errors: QC error bitmask column
+    :return: dict with indexes of broken rows as keys and lists of error messages as values
+    """
+    broken_rows = qc_errors[qc_errors != 0]
+    decoded_masks = {error_mask: decode_qc_errors(error_mask) for error_mask in broken_rows.unique()}
+    return {row_ind: decoded_masks[error_mask] for row_ind, error_mask in broken_rows.items()}
+
+
+def get_error_summary(qc_errors: pd.Series) -> pd.Series:
+    """
+    :param qc_errors: QC error bitmask column
+    :return: number of rows for every error message
+    """
+    mask_counts = qc_errors[qc_errors != 0].value_counts()
+    return pd.Series({message: int(mask_counts[(mask_counts.index & bit) != 0].sum())
+                      for message, bit in QC_ERROR_BITS.items()}, name='count')
+
 
 class ChunkQC:
     def __init__(self, chunk_df: pd.DataFrame) -> None:
@@ -140,42 +214,30 @@ class ChunkQC:
         if missing_columns:
             raise ValueError(f'The following columns are missing: {missing_columns}')
 
-    def process_chunk(self) -> dict[int: str]:
+    def process_chunk(self) -> pd.Series:
         """
         Applies QC functions to chunk
-        :return: dict with indexes of importer rows as keys and error messages as values
+        :return: QC error bitmask for every row of the chunk, see QC_ERROR_BITS
         """
-
-        chunk_error_messages = defaultdict(list)
-
         self.check_exist()
         self.check_header()
 
-        chunk_duplicates = self.chunk_df[self.chunk_df.duplicated(subset=SIGNATURE_COLS)]
-        if len(chunk_duplicates):
-            for duplicated_row_ind in chunk_duplicates.index:
-                chunk_error_messages[duplicated_row_ind].append('duplicate')
+        columns = {column: _as_str(self.chunk_df[column]) for column in validators.keys()}
+        qc_errors = np.zeros(len(self.chunk_df), dtype=np.int64)
 
-        for validating_column in validators.keys():
-            validator_res_mask = self.chunk_df[validating_column].apply(lambda x: validators[validating_column](x))
-            if not all(validator_res_mask):
-                for broken_row_ind in self.chunk_df[~validator_res_mask].index:
-                    chunk_error_messages[broken_row_ind].append(f'bad {validating_column}')
+        def flag(mask: pd.Series, message: str) -> None:
+            qc_errors[mask.to_numpy(dtype=bool)] |= QC_ERROR_BITS[message]
 
-        empty_cdr3_rows = self.chunk_df[self.chunk_df.T.apply(lambda x: pd.isnull(x["cdr3.alpha"])
-                                                                        and pd.isnull(x["cdr3.beta"]))]
-        for empty_row_ind in empty_cdr3_rows.index:
-            chunk_error_messages[empty_row_ind].append('no.cdr3')
+        flag(self.chunk_df.duplicated(subset=SIGNATURE_COLS), 'duplicate')
 
-        empty_epitope_rows = self.chunk_df[self.chunk_df["antigen.epitope"].apply(pd.isnull)]
-        for empty_row_ind in empty_epitope_rows.index:
-            chunk_error_messages[empty_row_ind].append('no.antigen.seq')
+        for validating_column, validator in validators.items():
+            flag(~validator(columns[validating_column]), f'bad {validating_column}')
 
-        empty_mhc_rows = self.chunk_df[self.chunk_df.T.apply(lambda x: pd.isnull(x["mhc.a"]) or pd.isnull(x["mhc.b"]))]
-        for empty_row_index in empty_mhc_rows.index:
-            chunk_error_messages[empty_row_index].append('no.mhc')
+        flag(columns["cdr3.alpha"].isnull() & columns["cdr3.beta"].isnull(), 'no.cdr3')
+        flag(columns["antigen.epitope"].isnull(), 'no.antigen.seq')
+        flag(columns["mhc.a"].isnull() | columns["mhc.b"].isnull(), 'no.mhc')
 
-        return chunk_error_messages
+        return pd.Series(qc_errors, index=self.chunk_df.index, name='qc.errors')
 
 
 def gene_match_check(gene_name: str) -> bool:
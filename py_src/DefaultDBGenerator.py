@@ -1,3 +1,4 @@
+import os
 import pandas as pd
 import json
 import csv
@@ -6,27 +7,95 @@ import sys
 from multiprocessing import Pool
 import numpy as np
 import warnings
+from collections import defaultdict
+from functools import lru_cache
+from typing import Optional
+from termcolor import cprint
+
+from BuildCache import PgenCache
+from Utils import hash_dir
 warnings.filterwarnings('ignore')  # Place this at the top of your script
 
 sys.path.append('../../')
 sys.path.append('../../mirpy')
 
-from mirpy.mir.basic import pgen
+OLGA_MODELS_DIR = '../../mirpy/mir/resources/olga/default_models/'
 
-olga_pgen_human_trb = pgen.OlgaModel(model='../../mirpy/mir/resources/olga/default_models/human_T_beta')
-olga_pgen_human_tra = pgen.OlgaModel(model='../../mirpy/mir/resources/olga/default_models/human_T_alpha',
-                                     is_d_present=False)
-olga_pgen_mouse_trb = pgen.OlgaModel(model='../../mirpy/mir/resources/olga/default_models/mouse_T_beta')
-olga_pgen_mouse_tra = pgen.OlgaModel(model='../../mirpy/mir/resources/olga/default_models/mouse_T_alpha',
-                                     is_d_present=False)
+# model directory and extra OlgaModel arguments by species and gene
+OLGA_MODELS = {
+    'homosapiens_TRB': ('human_T_beta', {}),
+    'homosapiens_TRA': ('human_T_alpha', {'is_d_present': False}),
+    'musmusculus_TRB': ('mouse_T_beta', {}),
+    'musmusculus_TRA': ('mouse_T_alpha', {'is_d_present': False})
+}
 
+# registry of OLGA models loaded by the current process
+models_dict = {}
 
-models_dict = {
-    'homosapiens_TRB': olga_pgen_human_trb,
-    'homosapiens_TRA': olga_pgen_human_tra,
-    'musmusculus_TRB': olga_pgen_mouse_trb,
-    'musmusculus_TRA': olga_pgen_mouse_tra
-}
+MIRPY_REQUIRED_MESSAGE = "mirpy is required to compute Pgen, clone it next to the repository " \
+                         "or build the database with --no-pgen"
+
+
+def get_model_dir(model_name: str) -> str:
+    """
+    :param model_name: OLGA_MODELS key
+    :return: path to the model files, ImportError is raised if they are missing as mirpy is not cloned then
+    """
+    model_dir = f'{OLGA_MODELS_DIR}{OLGA_MODELS[model_name][0]}'
+    if not os.path.isdir(model_dir):
+        raise ImportError(f"{MIRPY_REQUIRED_MESSAGE}, {model_dir} not found")
+    return model_dir
+
+
+def load_model(model_name: str):
+    """
+    :param model_name: OLGA_MODELS key
+    :return: OLGA model
+    """
+    try:
+        from mirpy.mir.basic import pgen
+    except ImportError as e:
+        raise ImportError(MIRPY_REQUIRED_MESSAGE) from e
+    return pgen.OlgaModel(model=get_model_dir(model_name), **OLGA_MODELS[model_name][1])
+
+
+def get_model(model_name: str):
+    """
+    :param model_name: OLGA_MODELS key
+    :return: OLGA model, loaded on first use
+    """
+    model = models_dict.get(model_name)
+    if model is None:
+        model = models_dict[model_name] = load_model(model_name)
+    return model
+
+
+def init_pgen_worker(model_names: list) -> None:
+    """
+    Loads only the models needed by the Pgen pool
+    :param model_names: OLGA_MODELS keys
+    """
+    for model_name in model_names:
+        get_model(model_name)
+
+
+@lru_cache(maxsize=None)
+def get_model_hash(model_name: str) -> str:
+    """
+    :param model_name: OLGA_MODELS key
+    :return: hash of the model files
+    """
+    return hash_dir(get_model_dir(model_name))
+
+
+def get_model_name(gene: str, specie: str) -> Optional[str]:
+    """
+    :return: OLGA_MODELS key for the gene and species or None if there is no model
+    """
+    specie = specie.lower()
+    if specie not in {'musmusculus', 'homosapiens'}:
+        return None
+    return f'{specie}_{gene}'
 
 VERY_HIGH_CONFIDENCE_CUTOFF_B = -7.3
 HIGH_CONFIDENCE_CUTOFF_B = -12.1
@@ -44,16 +113,50 @@ VERY_HIGH_CONFIDENCE_CUTOFF_MOUSE_A = -4.5
 HIGH_CONFIDENCE_CUTOFF_MOUSE_A = -8.3
 MEDIUM_CONFIDENCE_CUTOFF_MOUSE_A = -10
 
-def calc_pgen(multiargument):
-    cdr3aa = multiargument[0]
-    gene = multiargument[1]
-    specie = multiargument[2].lower()
-    if specie not in {'musmusculus', 'homosapiens'}:
-        return None
-    model = models_dict[f'{specie}_{gene}']
-    p_gen = model.compute_pgen_cdr3aa(cdr3aa)
-    log10_pgen = np.log10(p_gen)
-    return log10_pgen
+def calc_key_pgen(key: tuple) -> tuple:
+    """
+    :param key: (OLGA_MODELS key, cdr3aa) tuple
+    :return: key and log10 Pgen of the cdr3
+    """
+    model_name, cdr3aa = key
+    return key, np.log10(get_model(model_name).compute_pgen_cdr3aa(cdr3aa))
+
+
+def get_available_cpus() -> int:
+    """
+    :return: number of CPUs the process may run on
+    """
+    return len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+
+
+def schedule_pgens(keys: list, jobs: Optional[int] = None, chunksize: Optional[int] = None) -> dict:
+    """
+    Computes log10 Pgen in a pool whose workers load only the models of the keys
+    :param keys: list of unique (OLGA_MODELS key, cdr3aa) tuples
+    :param jobs: number of processes, available CPUs by default, computes in current process if 1
+    :param chunksize: number of keys per task, several tasks per process by default
+    :return: dict of log10 Pgen by key
+    """
+    jobs = min(jobs or get_available_cpus(), len(keys))
+    chunksize = chunksize or max(1, min(1000, len(keys) // (jobs * 16)))
+    model_names = sorted({model_name for model_name, _ in keys})
+    progress_step = max(1, len(keys) // 10)
+
+    log_10_pgens = {}
+    pool = Pool(jobs, initializer=init_pgen_worker, initargs=(model_names,)) if jobs > 1 else None
+    if pool is None:
+        init_pgen_worker(model_names)
+    try:
+        results = pool.imap_unordered(calc_key_pgen, keys, chunksize) if pool else map(calc_key_pgen, keys)
+        for key, log_10_pgen in results:
+            log_10_pgens[key] = log_10_pgen
+            if len(log_10_pgens) % progress_step == 0 or len(log_10_pgens) == len(keys):
+                cprint(f"Pgen computed for {len(log_10_pgens)} of {len(keys)} sequences", "magenta")
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+    return log_10_pgens
 
 
 def get_web_method(method_identification: str) -> str:
@@ -107,72 +210,171 @@ SIGNATURE_COLS_PER_SAMPLE = [
 ]
 
 
-def generate_default_db(master_table: pd.DataFrame) -> pd.DataFrame:
+CHAIN_GENES = {"alpha": "TRA", "beta": "TRB"}
+
+
+def get_web_methods(method_identification: pd.Series) -> np.ndarray:
+    """
+    Vectorized get_web_method
+    """
+    method_identification = method_identification.str.lower()
+    return np.select([method_identification.str.contains("sort", regex=False),
+                      method_identification.str.contains("culture", regex=False)
+                      | method_identification.str.contains("cloning", regex=False)
+                      | method_identification.str.contains("targets", regex=False)],
+                     ["sort", "culture"], "other").astype(object)
+
+
+def get_web_methods_seq(clones: pd.DataFrame) -> np.ndarray:
+    """
+    Vectorized get_web_method_seq
+    """
+    method_data = clones["method.sequencing"].str.lower()
+    return np.select([clones["method.singlecell"] != "",
+                      method_data.str.contains("sanger", regex=False),
+                      method_data.str.contains("-seq", regex=False)],
+                     ["singlecell", "sanger", "amplicon"], "other").astype(object)
+
+
+def explode_chains(master_table: pd.DataFrame, complex_id_offset: int = 0) -> pd.DataFrame:
+    """
+    Reshapes clones into one row per chain, alpha chain row goes first.
+    Paired clones get consecutive complex ids, unpaired ones get 0
+    :param master_table: full vdj db table with empty strings for missing values and
+    samples.found and studies.found columns
+    :param complex_id_offset: number of paired clones preceding the table, allows to explode table shards separately
+    :return: default vdj db table without pgen scores
+    """
+    master_table = master_table.reset_index(drop=True)
+    paired_mask = (master_table["cdr3.alpha"] != "") & (master_table["cdr3.beta"] != "")
+    complex_ids = np.where(paired_mask, paired_mask.cumsum() + complex_id_offset, 0)
+
+    methods = master_table[METHOD_COLUMNS].set_axis([coll.split("method.")[1] for coll in METHOD_COLUMNS],
+                                                    axis=1).to_dict("records")
+    metas = master_table[META_COLUMNS + ["samples.found", "studies.found"]].set_axis(
+        [coll.split("meta.")[1] for coll in META_COLUMNS] + ["samples.found", "studies.found"],
+        axis=1).to_dict("records")
+    web_methods = get_web_methods(master_table["method.identification"])
+    web_methods_seq = get_web_methods_seq(master_table)
+
+    chain_tables = []
+    for chain_order, (chain, gene) in enumerate(CHAIN_GENES.items()):
+        rows = np.flatnonzero(master_table[f"cdr3.{chain}"].astype(bool).to_numpy())
+        chain_table = pd.DataFrame({
+            "complex.id": complex_ids[rows],
+            "gene": gene,
+            "cdr3": master_table[f"cdr3.{chain}"].to_numpy()[rows],
+            "v.segm": master_table[f"v.{chain}"].to_numpy()[rows],
+            "j.segm": master_table[f"j.{chain}"].to_numpy()[rows],
+        })
+        for coll in COMPLEX_ANNOT_COLS:
+            chain_table[coll] = master_table[coll].to_numpy()[rows]
+        chain_table["method"] = [dict(methods[row]) for row in rows]
+        chain_table["meta"] = [dict(metas[row]) for row in rows]
+        cdr3fixes = master_table[f"cdr3fix.{chain}"].to_numpy()[rows]
+        chain_table["cdr3fix"] = cdr3fixes
+        chain_table["web.method"] = web_methods[rows]
+        chain_table["web.method.seq"] = web_methods_seq[rows]
+        chain_table["web.cdr3fix.nc"] = [np.nan if cdr3fix == "" else
+                                         "no" if cdr3fix["jCanonical"] and cdr3fix["vCanonical"] else "yes"
+                                         for cdr3fix in cdr3fixes]
+        chain_table["web.cdr3fix.unmp"] = [np.nan if cdr3fix == "" else
+                                           "no" if cdr3fix["vEnd"] > -1 and cdr3fix["jStart"] else "yes"
+                                           for cdr3fix in cdr3fixes]
+        chain_table["row"] = rows
+        chain_table["chain.order"] = chain_order
+        chain_tables.append(chain_table)
+
+    return pd.concat(chain_tables, ignore_index=True) \
+        .sort_values(["row", "chain.order"], kind="stable") \
+        .drop(columns=["row", "chain.order"]) \
+        .reset_index(drop=True)
+
+
+def encode_complex_columns(default_db: pd.DataFrame) -> pd.DataFrame:
+    """
+    :param default_db: default vdj db table
+    :return: copy of the table with json encoded method, meta and cdr3fix columns as written to vdjdb.txt
+    """
+    default_db_to_write = default_db.copy()
+
+    for complex_col in ["method", "meta", "cdr3fix"]:
+        default_db_to_write[complex_col] = default_db_to_write[complex_col].apply(lambda x: json.dumps(x))
+    return default_db_to_write
+
+
+def compute_pgens(default_db: pd.DataFrame, pgen_cache: Optional[PgenCache] = None,
+                  jobs: Optional[int] = None, chunksize: Optional[int] = None) -> list:
+    """
+    Computes log10 Pgen of the unique cdr3 sequences of every model, only sequences missing in the cache
+    are sent to OLGA
+    :param default_db: default vdj db table
+    :param pgen_cache: PgenCache to take computed values from and store new ones to
+    :param jobs: number of processes for Pgen computation, available CPUs by default
+    :param chunksize: number of sequences per Pgen task
+    :return: list of log10 Pgen values aligned with default_db rows, None if there is no model for the species
+    """
+    keys = [(get_model_name(gene, specie), cdr3) for cdr3, gene, specie
+            in zip(default_db.cdr3, default_db.gene, default_db.species)]
+    unique_keys = {key for key in keys if key[0] is not None}
+    log_10_pgens = {}
+
+    if pgen_cache:
+        cdr3s_by_model = defaultdict(set)
+        for model_name, cdr3 in unique_keys:
+            cdr3s_by_model[model_name].add(cdr3)
+        for model_name, cdr3s in cdr3s_by_model.items():
+            cached = pgen_cache.get_many(model_name, get_model_hash(model_name), cdr3s)
+            log_10_pgens.update(((model_name, cdr3), log_10_pgen) for cdr3, log_10_pgen in cached.items())
+        cprint(f"Pgen cache: {pgen_cache.get_stats()}", "magenta")
+
+    keys_to_compute = sorted(unique_keys.difference(log_10_pgens))
+    if keys_to_compute:
+        computed = schedule_pgens(keys_to_compute, jobs, chunksize)
+        log_10_pgens.update(computed)
+        if pgen_cache:
+            computed_by_model = defaultdict(dict)
+            for (model_name, cdr3), log_10_pgen in computed.items():
+                computed_by_model[model_name][cdr3] = log_10_pgen
+            for model_name, pgens in computed_by_model.items():
+                pgen_cache.put_many(model_name, get_model_hash(model_name), pgens)
+
+    return [log_10_pgens.get(key) for key in keys]
+
+
+def generate_default_db(master_table: pd.DataFrame, pgen_cache: Optional[PgenCache] = None,
+                        pgen_jobs: Optional[int] = None, pgen_chunksize: Optional[int] = None,
+                        no_pgen: bool = False) -> pd.DataFrame:
     """
     Generates vdjdb default txt file from full table. Writes it to /database/ folder
     :param master_table: full vdj db table
+    :param pgen_cache: PgenCache to reuse Pgen values of previous builds
+    :param pgen_jobs: number of processes for Pgen computation, available CPUs by default
+    :param pgen_chunksize: number of sequences per Pgen task
+    :param no_pgen: skip Pgen computation, vdjdb.pgen.score is 0 for all rows then
     :return: default vdj db table
     """
-    master_table.fillna("", inplace=True)
+    # the caller keeps using the full table, so NaNs are filled in a copy
+    master_table = master_table.fillna("")
 
-    master_table_gene_not_empty_mask = master_table.T.apply(
-        lambda x: (bool(x['v.alpha']) and bool(x['j.alpha']) if bool(x['cdr3.alpha']) else True) and (
-            bool(x['v.beta']) and bool(x['j.beta']) if bool(x['cdr3.beta']) else True
-        ))
+    master_table_gene_not_empty_mask = np.ones(len(master_table), dtype=bool)
+    for chain in CHAIN_GENES:
+        master_table_gene_not_empty_mask &= ~master_table[f"cdr3.{chain}"].astype(bool).to_numpy() | (
+            master_table[f"v.{chain}"].astype(bool).to_numpy() & master_table[f"j.{chain}"].astype(bool).to_numpy())
 
     master_table = master_table.loc[master_table_gene_not_empty_mask]
 
-    complex_id_count = 0
+    master_table = master_table.assign(**{
+        "samples.found": master_table.groupby(SIGNATURE_COLS_PER_SAMPLE, sort=False)["species"].transform("size"),
+        "studies.found": master_table.groupby(SIGNATURE_COLS, sort=False)["reference.id"].transform("nunique")
+    })
 
-    sample_counts = master_table.value_counts(subset=SIGNATURE_COLS_PER_SAMPLE)
-    study_counts = master_table.set_index(SIGNATURE_COLS)
-    clones_list = []
+    default_db = explode_chains(master_table)
 
-    for _, clone in master_table.iterrows():
-
-        if not ((clone["cdr3.alpha"] == "") or (clone["cdr3.beta"] == "")):
-            complex_id_count += 1
-            complex_id = complex_id_count
-        else:
-            complex_id = 0
-
-        for chain in ["alpha", "beta"]:
-            if clone[f"cdr3.{chain}"]:
-                clone_compact = {
-                    "complex.id": complex_id,
-                    "gene": "TRA" if chain == "alpha" else "TRB",
-                    "cdr3": clone[f"cdr3.{chain}"],
-                    "v.segm": clone[f"v.{chain}"],
-                    "j.segm": clone[f"j.{chain}"],
-                }
-
-                for coll in COMPLEX_ANNOT_COLS:
-                    clone_compact[coll] = clone[coll]
-                clone_compact["method"] = {coll.split("method.")[1]: clone[coll] for coll in METHOD_COLUMNS}
-                clone_compact["meta"] = {coll.split("meta.")[1]: clone[coll] for coll in META_COLUMNS}
-                clone_compact["meta"]["samples.found"] = int(sample_counts.loc[tuple(clone[coll] for coll
-                                                                                 in SIGNATURE_COLS_PER_SAMPLE)])
-                clone_compact["meta"]["studies.found"] \
-                    = len(study_counts.loc[tuple(clone[coll]
-                                                 for coll in
-                                                 SIGNATURE_COLS)].index.get_level_values(14).unique())
-
-                clone_compact["cdr3fix"] = clone[f"cdr3fix.{chain}"]
-                clone_compact["web.method"] = get_web_method(clone["method.identification"])
-                clone_compact["web.method.seq"] = get_web_method_seq(clone)
-                if clone_compact["cdr3fix"] != "":
-                    clone_compact["web.cdr3fix.nc"] = "no" if clone_compact["cdr3fix"]["jCanonical"] \
-                                                              and clone_compact["cdr3fix"]["vCanonical"] else "yes"
-                    clone_compact["web.cdr3fix.unmp"] = "no" if clone_compact["cdr3fix"]["vEnd"] > -1 \
-                                                                and clone_compact["cdr3fix"]["jStart"] else "yes"
-
-                clones_list.append(clone_compact)
-    default_db = pd.DataFrame(clones_list)
-
-    with Pool(24) as p:
-        log_10_pgens = list(p.map(calc_pgen, [(x.cdr3, x.gene, x.species) for _, x in default_db.iterrows()]))
-
-    default_db['log_10_pgen'] = log_10_pgens
+    if no_pgen:
+        default_db['log_10_pgen'] = np.nan
+    else:
+        default_db['log_10_pgen'] = compute_pgens(default_db, pgen_cache, pgen_jobs, pgen_chunksize)
 
     homosapiens_beta_score = pd.cut(default_db[(default_db.species == 'HomoSapiens') & (default_db.gene == 'TRB')].log_10_pgen,
                               [-500, MEDIUM_CONFIDENCE_CUTOFF_B, HIGH_CONFIDENCE_CUTOFF_B,
@@ -193,10 +395,6 @@ def generate_default_db(master_table: pd.DataFrame) -> pd.DataFrame:
     default_db['vdjdb.pgen.score'] = default_db['vdjdb.pgen.score'].fillna(0)
     default_db['vdjdb.pgen.score'] = default_db['vdjdb.pgen.score'].apply(int)
     default_db = default_db.drop('log_10_pgen', axis=1) # delete after front fix
-    default_db_to_write = default_db.copy()
-
-    for complex_col in ["method", "meta", "cdr3fix"]:
-        default_db_to_write[complex_col] = default_db_to_write[complex_col].apply(lambda x: json.dumps(x))
-
+    default_db_to_write = encode_complex_columns(default_db)
     default_db_to_write.set_index("complex.id").to_csv("../database/vdjdb.txt", sep="\t", quoting=csv.QUOTE_NONE)
     return default_db
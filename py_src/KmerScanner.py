@@ -19,35 +19,124 @@ class KmerScanner:
 
     def __init__(self, seq, min_hit_size=2):
         """
-        Initiate KmerScanner by creating set of kmers from segment sequence
+        Initiate KmerScanner by building suffix automaton of the segment sequence
         :param seq: amino acids sequence of the segment
         :param min_hit_size: minimal overlap between cdr3 sequence and segment sequence
         """
         self.min_hit_size = min_hit_size
-        self.kmers = {}
+        # automaton states: outgoing transitions, suffix link, length of the longest substring
+        # and last end position of the state substrings in the segment
+        self.transitions = [{}]
+        self.links = [-1]
+        self.lengths = [0]
+        self.last_ends = [-1]
 
-        for i in range(min_hit_size, len(seq) + 1):
-            for j in range(0, len(seq) - i + 1):
-                kmer = seq[j:j + i]
-                self.kmers[kmer] = j
+        last = 0
+        for pos, symbol in enumerate(seq):
+            current = self._add_state(self.lengths[last] + 1, pos)
+            state = last
+            while state != -1 and symbol not in self.transitions[state]:
+                self.transitions[state][symbol] = current
+                state = self.links[state]
+            if state == -1:
+                self.links[current] = 0
+            else:
+                next_state = self.transitions[state][symbol]
+                if self.lengths[state] + 1 == self.lengths[next_state]:
+                    self.links[current] = next_state
+                else:
+                    clone = self._add_state(self.lengths[state] + 1, -1)
+                    self.transitions[clone] = dict(self.transitions[next_state])
+                    self.links[clone] = self.links[next_state]
+                    while state != -1 and self.transitions[state].get(symbol) == next_state:
+                        self.transitions[state][symbol] = clone
+                        state = self.links[state]
+                    self.links[next_state] = clone
+                    self.links[current] = clone
+            last = current
+
+        # suffix link parents occur wherever their children occur
+        for state in sorted(range(1, len(self.lengths)), key=lambda x: self.lengths[x], reverse=True):
+            link = self.links[state]
+            self.last_ends[link] = max(self.last_ends[link], self.last_ends[state])
+
+    def _add_state(self, length, last_end) -> int:
+        self.transitions.append({})
+        self.links.append(-1)
+        self.lengths.append(length)
+        self.last_ends.append(last_end)
+        return len(self.lengths) - 1
 
     def scan(self, seq) -> Optional[SearchResult]:
         """
-        scans other cdr3 sequences to get overlap with segment sequence
+        scans other cdr3 sequences to get overlap with segment sequence.
+        Longest overlap not including the last cdr3 symbol is reported, the earliest one in cdr3 and
+        the last one in segment if there are several
         :param seq: amino acids sequence of cdr3 to be fixed
         :return: search results with best overlap coordinates in cdr3
         """
-        best_hit = None
-        for i in range(self.min_hit_size, len(seq)):
-            for j in range(len(seq) - i):
-                kmer = seq[j:j + i]
-                hit = self.kmers.get(kmer)
-                if hit is not None:
-                    current_hit = SearchResult(hit, j, len(kmer))
-                else:
-                    current_hit = SearchResult(-1, j, -1)
+        state = 0
+        match_size = 0
+        best_match_size = 0
+        best_end = -1
+        best_state = 0
+        for pos in range(len(seq) - 1):
+            symbol = seq[pos]
+            while state and symbol not in self.transitions[state]:
+                state = self.links[state]
+                match_size = self.lengths[state]
+            state = self.transitions[state].get(symbol, 0)
+            match_size = match_size + 1 if state else 0
+
+            if match_size > best_match_size:
+                best_match_size = match_size
+                best_end = pos
+                best_state = state
+
+        if best_match_size < max(self.min_hit_size, 1):
+            return None
+        return SearchResult(self.last_ends[best_state] - best_match_size + 1,
+                            best_end - best_match_size + 1,
+                            best_match_size)
 
+
+if __name__ == "__main__":
+    # equivalence check against the kmer dictionary scanner KmerScanner was previously implemented with
+    import random
+    import pandas as pd
+    from Utils import translate_linear
+
+    def scan_by_kmers(segment_seq, cdr3, min_hit_size):
+        kmers = {}
+        for i in range(min_hit_size, len(segment_seq) + 1):
+            for j in range(0, len(segment_seq) - i + 1):
+                kmers[segment_seq[j:j + i]] = j
+
+        best_hit = None
+        for i in range(min_hit_size, len(cdr3)):
+            for j in range(len(cdr3) - i):
+                hit = kmers.get(cdr3[j:j + i])
+                current_hit = SearchResult(hit, j, i) if hit is not None else SearchResult(-1, j, -1)
                 if best_hit is None or (current_hit.match_size > best_hit.match_size):
                     best_hit = current_hit
-
         return best_hit if best_hit and best_hit.match_size > 0 else None
+
+    segments = pd.read_csv("../res/segments.txt", sep="\t")
+    segment_seqs = [translate_linear(seq) for seq in segments.sequence] + \
+                   [translate_linear(seq, True)[::-1] for seq in segments.sequence]
+    random.seed(42)
+    alphabet = "ACDEFGSW"
+    checked = 0
+    for segment_seq in random.sample(segment_seqs, 300) + \
+            ["".join(random.choices(alphabet, k=random.randint(0, 30))) for _ in range(300)]:
+        for min_hit_size in [1, 2, 3]:
+            scanner = KmerScanner(segment_seq, min_hit_size)
+            for _ in range(20):
+                start = random.randint(0, max(len(segment_seq) - 1, 0))
+                cdr3 = "".join(random.choices(alphabet, k=random.randint(0, 4))) + \
+                    segment_seq[start:start + random.randint(0, 12)] + \
+                    "".join(random.choices(alphabet, k=random.randint(0, 6)))
+                expected = scan_by_kmers(segment_seq, cdr3, min_hit_size)
+                assert scanner.scan(cdr3) == expected, (segment_seq, cdr3, min_hit_size, expected)
+                checked += 1
+    print(f"KmerScanner matches kmer dictionary scanner on {checked} random scans")
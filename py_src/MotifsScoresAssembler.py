@@ -1,67 +1,73 @@
+import numpy as np
 import pandas as pd
 import csv
 
-vdjdb_full = pd.read_csv('../database/vdjdb_full.txt', sep='\t',)
-cluster_members = pd.read_csv('../database/cluster_members.txt', sep='\t')
+FULL_CHAIN_COLS = {
+    'TRA': 'cdr3.alpha',
+    'TRB': 'cdr3.beta'
+}
 
-vdjdb_full_clusters = vdjdb_full.copy()
-vdjdb_full_clusters['cluster.member'] = 0
-
-cluster_index_col = [
-    'antigen.epitope',
-    'species',
-    'cdr3.alpha'
-]
-
-vdjdb_full_clusters = vdjdb_full_clusters.set_index(cluster_index_col)
-
-cluster_members_tra = cluster_members[cluster_members['gene'] == 'TRA']
-
-for _, cluster_member in cluster_members_tra.iterrows():
-    vdjdb_full_clusters.loc[tuple(cluster_member[cluster_index_col[:-1] + ['cdr3aa']]), 'cluster.member'] = 1
-
-vdjdb_full_clusters.reset_index(inplace=True)
-
-cluster_index_col[-1] = 'cdr3.beta'
-
-vdjdb_full_clusters = vdjdb_full_clusters.set_index(cluster_index_col)
-
-cluster_members_trb = cluster_members[cluster_members['gene'] == 'TRB']
-
-for _, cluster_member in cluster_members_trb.iterrows():
-    vdjdb_full_clusters.loc[tuple(cluster_member[cluster_index_col[:-1] + ['cdr3aa']]), "cluster.member"] = 1
-
-vdjdb_full_clusters = vdjdb_full_clusters.reset_index()[list(vdjdb_full.columns) + ['cluster.member']]
-vdjdb_full_clusters.set_index('cdr3.alpha').to_csv('../database/vdjdb_full_scored.txt', sep='\t',
-                                                   quoting=csv.QUOTE_NONE)
-
-slim_db = pd.read_csv('../database/vdjdb.slim.txt', sep='\t',)
-
-cluster_index_col = [
+CLUSTER_INDEX_COLS = [
     'antigen.epitope',
     'species',
     'gene'
 ]
 
-slim_db_scored = slim_db.copy()
-slim_db_scored = slim_db_scored.set_index(cluster_index_col)
-slim_db_scored['cluster.member'] = 0
-
-for _, cluster_member in cluster_members.iterrows():
-    slim_db_scored.loc[tuple(cluster_member[cluster_index_col]), 'cluster.member'] = 1
-
-slim_db_scored = slim_db_scored.reset_index()[list(slim_db.columns) + ['cluster.member']]
-slim_db_scored.set_index('gene').to_csv('../database/vdjdb.slim.scored.txt', sep='\t', quoting=csv.QUOTE_NONE)
-
-default_db = pd.read_csv('../database/vdjdb.txt', sep='\t',)
-col_order = list(default_db.columns)
-default_db['cluster.member'] = 0
-
-default_db = default_db.set_index(cluster_index_col)
-
-for _, cluster_member in cluster_members.iterrows():
-    default_db.loc[tuple(cluster_member[cluster_index_col]), 'cluster.member'] = 1
 
-default_db.reset_index(inplace=True)
-default_db[col_order + ['cluster.member']].set_index('complex.id').to_csv('../database/vdjdb.scored.txt',
-                                                                          sep='\t', quoting=csv.QUOTE_NONE)
+def flag_full_cluster_members(vdjdb_full: pd.DataFrame, cluster_members: pd.DataFrame) -> pd.DataFrame:
+    """
+    Flags clones having a chain that is a member of a motif cluster of their epitope
+    :param vdjdb_full: full vdj db table
+    :param cluster_members: motif cluster members table with antigen.epitope, species, gene and cdr3aa columns
+    :return: copy of the full table with cluster.member column
+    """
+    member_index = pd.MultiIndex.from_frame(cluster_members[CLUSTER_INDEX_COLS + ['cdr3aa']])
+    # both chains of every clone are checked in one semi-join
+    chain_index = pd.MultiIndex.from_arrays([
+        np.tile(vdjdb_full['antigen.epitope'].to_numpy(dtype=object), len(FULL_CHAIN_COLS)),
+        np.tile(vdjdb_full['species'].to_numpy(dtype=object), len(FULL_CHAIN_COLS)),
+        np.repeat(np.array(list(FULL_CHAIN_COLS), dtype=object), len(vdjdb_full)),
+        np.concatenate([vdjdb_full[col].to_numpy(dtype=object) for col in FULL_CHAIN_COLS.values()])
+    ])
+    is_member = chain_index.isin(member_index).reshape(len(FULL_CHAIN_COLS), len(vdjdb_full)).any(axis=0)
+
+    vdjdb_full_clusters = vdjdb_full.copy()
+    vdjdb_full_clusters['cluster.member'] = is_member.astype(int)
+    return vdjdb_full_clusters
+
+
+def flag_cluster_members(db: pd.DataFrame, cluster_members: pd.DataFrame) -> pd.DataFrame:
+    """
+    Flags records of epitope, species and gene having motif clusters
+    :param db: default or slim vdj db table
+    :param cluster_members: motif cluster members table with antigen.epitope, species and gene columns
+    :return: copy of the table with cluster.member column
+    """
+    member_index = pd.MultiIndex.from_frame(cluster_members[CLUSTER_INDEX_COLS])
+    db_scored = db.copy()
+    db_scored['cluster.member'] = pd.MultiIndex.from_frame(db[CLUSTER_INDEX_COLS]).isin(member_index).astype(int)
+    return db_scored
+
+
+def write_scored_tables(vdjdb_full: pd.DataFrame, slim_db: pd.DataFrame, default_db: pd.DataFrame,
+                        cluster_members: pd.DataFrame) -> None:
+    """
+    Writes full, slim and default tables with cluster.member column to /database/ folder
+    :param vdjdb_full: full vdj db table
+    :param slim_db: slim vdj db table
+    :param default_db: default vdj db table with json encoded method, meta and cdr3fix columns
+    :param cluster_members: motif cluster members table
+    """
+    flag_full_cluster_members(vdjdb_full, cluster_members).set_index('cdr3.alpha') \
+        .to_csv('../database/vdjdb_full_scored.txt', sep='\t', quoting=csv.QUOTE_NONE)
+    flag_cluster_members(slim_db, cluster_members).set_index('gene') \
+        .to_csv('../database/vdjdb.slim.scored.txt', sep='\t', quoting=csv.QUOTE_NONE)
+    flag_cluster_members(default_db, cluster_members).set_index('complex.id') \
+        .to_csv('../database/vdjdb.scored.txt', sep='\t', quoting=csv.QUOTE_NONE)
+
+
+if __name__ == "__main__":
+    write_scored_tables(pd.read_csv('../database/vdjdb_full.txt', sep='\t',),
+                        pd.read_csv('../database/vdjdb.slim.txt', sep='\t',),
+                        pd.read_csv('../database/vdjdb.txt', sep='\t',),
+                        pd.read_csv('../database/cluster_members.txt', sep='\t'))
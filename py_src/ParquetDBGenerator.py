@@ -0,0 +1,154 @@
+import warnings
+import pandas as pd
+
+from ChunkQC import METHOD_COLUMNS, META_COLUMNS
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+# low cardinality columns stored dictionary encoded
+DICTIONARY_COLUMNS = {
+    "gene",
+    "species",
+    "v.segm", "j.segm",
+    "v.alpha", "j.alpha", "v.beta", "d.beta", "j.beta",
+    "mhc.a", "mhc.b", "mhc.class",
+    "antigen.gene", "antigen.species",
+    "web.method", "web.method.seq", "web.cdr3fix.nc", "web.cdr3fix.unmp"
+}
+
+# meta fields computed by the build, all other method and meta values are stored as strings
+META_COUNT_FIELDS = ["samples.found", "studies.found"]
+
+CDR3FIX_FIELDS = [
+    ("cdr3", "string"),
+    ("cdr3_old", "string"),
+    ("fixNeeded", "bool"),
+    ("good", "bool"),
+    ("jCanonical", "bool"),
+    ("jFixType", "string"),
+    ("jId", "string"),
+    ("jStart", "int32"),
+    ("vCanonical", "bool"),
+    ("vEnd", "int32"),
+    ("vFixType", "string"),
+    ("vId", "string"),
+    # set by the stage II realignment
+    ("oldJFixType", "string"),
+    ("oldJId", "string"),
+    ("oldJStart", "int32"),
+    ("oldVEnd", "int32"),
+    ("oldVFixType", "string"),
+    ("oldVId", "string")
+]
+
+PARQUET_COMPRESSION = "zstd"
+
+
+def is_parquet_available() -> bool:
+    """
+    :return: True if pyarrow is installed
+    """
+    return pa is not None
+
+
+def _get_struct_types() -> dict:
+    """
+    :return: arrow types of json encoded columns
+    """
+    return {
+        "method": pa.struct([(coll.split("method.")[1], pa.string()) for coll in METHOD_COLUMNS]),
+        "meta": pa.struct([(coll.split("meta.")[1], pa.string()) for coll in META_COLUMNS] +
+                          [(field, pa.int32()) for field in META_COUNT_FIELDS]),
+        "cdr3fix": pa.struct([(field, pa.type_for_alias(field_type)) for field, field_type in CDR3FIX_FIELDS])
+    }
+
+
+def _normalize_values(value: dict) -> dict:
+    """
+    :param value: method or meta dict
+    :return: dict with string values except for the build counters
+    """
+    return {key: field_value if key in META_COUNT_FIELDS else str(field_value)
+            for key, field_value in value.items()}
+
+
+def _to_struct_array(values: pd.Series, struct_type, normalize: bool = False):
+    """
+    :param values: column of dicts, empty strings and nulls for missing values
+    :param struct_type: arrow struct type
+    :param normalize: convert values to strings, see _normalize_values
+    :return: arrow struct array
+    """
+    return pa.array([(_normalize_values(value) if normalize else value) if isinstance(value, dict) else None
+                     for value in values], type=struct_type)
+
+
+def _to_arrow_array(column: str, values: pd.Series):
+    """
+    :param column: column name
+    :param values: column values
+    :return: arrow array, string columns have nulls for empty values
+    """
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        values = values.astype(values.cat.categories.dtype)
+    if pd.api.types.is_bool_dtype(values.dtype) or pd.api.types.is_numeric_dtype(values.dtype):
+        return pa.array(values.to_numpy())
+
+    values = values.astype(object)
+    is_missing = values.isnull() | (values == "")
+    strings = values.where(is_missing, values.astype(str)).where(~is_missing, None)
+    array = pa.array(strings.to_numpy(), type=pa.string())
+    return array.dictionary_encode() if column in DICTIONARY_COLUMNS else array
+
+
+def to_arrow_table(df: pd.DataFrame, struct_columns: dict = None):
+    """
+    :param df: vdj db table
+    :param struct_columns: dict of json encoded column names by struct type name, see _get_struct_types
+    :return: arrow table with struct columns in place of json encoded ones
+    """
+    struct_types = _get_struct_types()
+    struct_columns = struct_columns or {}
+    arrays = []
+    for column in df.columns:
+        struct_type_name = struct_columns.get(column)
+        if struct_type_name:
+            arrays.append(_to_struct_array(df[column], struct_types[struct_type_name],
+                                           normalize=struct_type_name != "cdr3fix"))
+        else:
+            arrays.append(_to_arrow_array(column, df[column]))
+    return pa.Table.from_arrays(arrays, names=[str(column) for column in df.columns])
+
+
+def write_parquet(df: pd.DataFrame, file_name: str, struct_columns: dict = None) -> None:
+    """
+    :param df: vdj db table
+    :param file_name: output parquet file
+    :param struct_columns: dict of json encoded column names by struct type name
+    """
+    pq.write_table(to_arrow_table(df, struct_columns), file_name, compression=PARQUET_COMPRESSION)
+
+
+def generate_parquet_db(master_table: pd.DataFrame, default_db: pd.DataFrame, slim_db: pd.DataFrame) -> bool:
+    """
+    Writes full, default and slim tables in parquet format next to the txt ones in /database/ folder
+    :param master_table: full vdj db table
+    :param default_db: default vdj db table with method, meta and cdr3fix dicts
+    :param slim_db: slim vdj db table
+    :return: False if pyarrow is not installed and nothing was written
+    """
+    if not is_parquet_available():
+        warnings.warn("pyarrow is not installed, parquet tables are not written")
+        return False
+
+    write_parquet(master_table, "../database/vdjdb_full.parquet",
+                  {"cdr3fix.alpha": "cdr3fix", "cdr3fix.beta": "cdr3fix"})
+    write_parquet(default_db, "../database/vdjdb.parquet",
+                  {"method": "method", "meta": "meta", "cdr3fix": "cdr3fix"})
+    write_parquet(slim_db, "../database/vdjdb.slim.parquet")
+    return True
@@ -1,110 +1,110 @@
-from collections import defaultdict
 import re
+import numpy as np
 import pandas as pd
 
 
-class VdjdbScoreFactory:
-    def __init__(self, master_table: pd.DataFrame):
-        self.score_map = {}
-
-        for _, row in master_table.iterrows():
-            try:
-                sign = self.get_signature(row)
-
-                # Compute score
-                if pd.notnull(row["meta.structure.id"]):
-                    score = 3  # we have structure
-                else:
-                    freq_str = row["method.frequency"]
-                    freq = self.get_frequency(freq_str)
-                    count = self.get_number_of_cells(freq_str)
-
-                    assert freq <= 1.0, "Frequency exceeds 1.0"
-
-                    # Sequencing score
-                    seq_score = 1
-                    single_cell = row["method.singlecell"].strip().lower() if pd.notnull(row["method.singlecell"]) else \
-                    row["method.singlecell"]
-
-                    if pd.notnull(row["method.singlecell"]) and single_cell != "no":
-                        seq_score = 3
-                    else:
-                        sequencing_method = row["method.sequencing"].strip().lower() if pd.notnull(
-                            row["method.sequencing"]) else row["method.sequencing"]
-                        if sequencing_method == "sanger":
-                            seq_score = 3 if count >= 2 else 2
-                        elif sequencing_method == "amplicon-seq":
-                            seq_score = 3 if freq >= 0.01 else 1
-
-                    # Moderate confidence regarding specificity
-                    identify_method = row["method.identification"].lower().strip() if pd.notnull(
-                        row["method.identification"]) else row["method.identification"]
-                    spec_score1 = 0
-
-                    if self.culture_based_identification(identify_method):
-                        spec_score1 = 1 if freq >= 0.5 else 0
-                    else:
-                        if self.sort_based_method(identify_method):
-                            spec_score1 = 1 if freq >= 0.05 else 0
-                        elif self.stimulation_based_method(identify_method):
-                            spec_score1 = 1 if freq >= 0.25 else 0
-
-                    # High confidence regarding specificity
-                    verify_method = row["method.verification"].lower() if pd.notnull(row["method.verification"]) else \
-                    row["method.verification"]
-                    spec_score2 = 0
-
-                    if self.direct_verification(verify_method):
-                        spec_score2 = 3
-                    elif self.stimulation_based_method(verify_method):
-                        spec_score2 = 2
-                        seq_score = 3  # tcr was cloned
-                    elif self.sort_based_method(verify_method):
-                        spec_score2 = 1
-                        seq_score = 3  # tcr was cloned
-
-                    score = min(seq_score, spec_score1 + spec_score2)
-
-                self.score_map[sign] = max(self.score_map.get(sign, 0), score)
-
-            except Exception as e:
-                raise RuntimeError(
-                    f"Error: {e}\nin {row['reference.id']} {row['cdr3.alpha']} {row['cdr3.beta']}"
-                )
+SORT_METHOD_PATTERN = "sort|beads|separation|stain"
+STIMULATION_METHOD_PATTERN = "targets"
+CULTURE_METHOD_PATTERN = "culture|cloning"
+DIRECT_VERIFICATION_PATTERN = "direct"
 
-    @staticmethod
-    def get_number_of_cells(freq):
-        if pd.isnull(freq) or not isinstance(freq, str):
-            return 0
-        return int(re.split(r'/+', freq)[0]) if "/" in freq else 0
+CELL_COUNT_PATTERN = re.compile(r'^\s*[+-]?\d+\s*$')
 
-    @staticmethod
-    def get_frequency(freq):
-        if pd.isnull(freq):
-            return 0.0
-        elif isinstance(freq, str):
-            if "/" in freq:
-                x = [float(x) for x in re.split(r'/+', freq)]
-                return x[0] / x[1]
-            elif freq.endswith("%") and len(freq) > 1:
-                return float(freq[:-1]) / 100.0
-        return float(freq)
 
-    @staticmethod
-    def sort_based_method(method):
-        return any(x in method for x in ["sort", "beads", "separation", "stain"]) if pd.notnull(method) else False
+def _as_lower_str(column: pd.Series) -> pd.Series:
+    """
+    :return: lower case string values of the column, nulls are kept
+    """
+    column = column.astype(object)
+    return column.where(column.isnull(), column.astype(str)).str.lower()
 
-    @staticmethod
-    def stimulation_based_method(method):
-        return "targets" in method if pd.notnull(method) else False
 
-    @staticmethod
-    def culture_based_identification(method):
-        return any(x in method for x in ["culture", "cloning"]) if pd.notnull(method) else False
+def _contains(column: pd.Series, pattern: str) -> np.ndarray:
+    return column.str.contains(pattern, regex=True, na=False).to_numpy()
+
+
+class VdjdbScoreFactory:
+    def __init__(self, master_table: pd.DataFrame):
+        structure_mask = master_table["meta.structure.id"].notnull().to_numpy()
+        freq, count = self.parse_frequencies(master_table["method.frequency"])
+
+        # rows with structure are scored without looking at the method
+        failed_mask = ~structure_mask & (np.isnan(freq) | np.isnan(count))
+        failed_message = "bad method.frequency value"
+        if not failed_mask.any():
+            failed_mask = ~structure_mask & (freq > 1.0)
+            failed_message = "Frequency exceeds 1.0"
+        if failed_mask.any():
+            row = master_table.iloc[int(np.argmax(failed_mask))]
+            raise RuntimeError(
+                f"Error: {failed_message} {row['method.frequency']!r}\n"
+                f"in {row['reference.id']} {row['cdr3.alpha']} {row['cdr3.beta']}"
+            )
+
+        # Sequencing score
+        single_cell = _as_lower_str(master_table["method.singlecell"]).str.strip()
+        sequencing_method = _as_lower_str(master_table["method.sequencing"]).str.strip()
+        seq_score = np.select([(single_cell.notnull() & (single_cell != "no")).to_numpy(),
+                               (sequencing_method == "sanger").to_numpy(),
+                               (sequencing_method == "amplicon-seq").to_numpy()],
+                              [3,
+                               np.where(count >= 2, 3, 2),
+                               np.where(freq >= 0.01, 3, 1)], 1)
+
+        # Moderate confidence regarding specificity
+        identify_method = _as_lower_str(master_table["method.identification"])
+        spec_score1 = np.select([_contains(identify_method, CULTURE_METHOD_PATTERN),
+                                 _contains(identify_method, SORT_METHOD_PATTERN),
+                                 _contains(identify_method, STIMULATION_METHOD_PATTERN)],
+                                [freq >= 0.5, freq >= 0.05, freq >= 0.25], 0).astype(int)
+
+        # High confidence regarding specificity
+        verify_method = _as_lower_str(master_table["method.verification"])
+        spec_score2_conditions = [_contains(verify_method, DIRECT_VERIFICATION_PATTERN),
+                                  _contains(verify_method, STIMULATION_METHOD_PATTERN),
+                                  _contains(verify_method, SORT_METHOD_PATTERN)]
+        spec_score2 = np.select(spec_score2_conditions, [3, 2, 1], 0)
+        # tcr was cloned
+        seq_score = np.where(~spec_score2_conditions[0] & (spec_score2 > 0), 3, seq_score)
+
+        scores = np.where(structure_mask, 3, np.minimum(seq_score, spec_score1 + spec_score2))
+
+        # rows with the same signature get the best score among them
+        signatures = master_table[self.SIGNATURE_COLS].reset_index(drop=True)
+        self.scores = signatures.assign(score=scores.astype(int)) \
+            .groupby(self.SIGNATURE_COLS, dropna=False, sort=False)["score"].transform("max").to_numpy()
 
     @staticmethod
-    def direct_verification(method):
-        return "direct" in method if pd.notnull(method) else False
+    def parse_frequencies(frequencies: pd.Series) -> tuple:
+        """
+        :param frequencies: method.frequency column
+        :return: arrays of frequencies and numbers of cells, NaN for values that can not be parsed
+        """
+        frequencies = frequencies.astype(object).reset_index(drop=True)
+        is_null = frequencies.isnull()
+        is_str = frequencies.map(type).eq(str)
+        freq_str = frequencies.where(is_null, frequencies.astype(str))
+
+        has_slash = is_str & freq_str.str.contains("/", regex=False, na=False)
+        is_percent = is_str & ~has_slash & freq_str.str.endswith("%", na=False) & (freq_str.str.len() > 1)
+
+        fractions = freq_str[has_slash].str.split(r'/+', regex=True)
+        numerators = pd.to_numeric(fractions.str[0], errors="coerce")
+        denominators = pd.to_numeric(fractions.str[1], errors="coerce")
+        freq = pd.to_numeric(freq_str.where(~has_slash & ~is_percent), errors="coerce")
+        freq[is_percent] = pd.to_numeric(freq_str[is_percent].str[:-1], errors="coerce") / 100.0
+        freq[has_slash] = (numerators / denominators.where(denominators != 0)).to_numpy()
+        freq[is_null] = 0.0
+
+        count = pd.Series(0.0, index=frequencies.index)
+        count[has_slash] = numerators.where(fractions.str[0].str.match(CELL_COUNT_PATTERN, na=False)).to_numpy()
+        return freq.to_numpy(dtype=float), count.to_numpy(dtype=float)
+
+    def get_scores(self) -> np.ndarray:
+        """
+        :return: vdjdb scores aligned with master table rows
+        """
+        return self.scores
 
     SIGNATURE_COLS = [
         "cdr3.alpha",
@@ -119,9 +119,3 @@ class VdjdbScoreFactory:
         "mhc.class",
         "antigen.epitope"
     ]
-
-    def get_score(self, row):
-        return self.score_map.get(self.get_signature(row), 0)
-
-    def get_signature(self, row):
-        return "\t".join(str(row[col]) for col in self.SIGNATURE_COLS)
@@ -1,3 +1,4 @@
+import numpy as np
 import pandas as pd
 
 COMPLEX_SLIM_ANNOT_COLS = [
@@ -15,19 +16,51 @@ SUMMARY_COLS = ["complex.id",
                 "reference.id", "vdjdb.score", "vdjdb.pgen.score", "TCR_hash"]
 
 
-def _aggregating_function(x):
-    return ','.join(sorted(set(x.dropna().apply(str))))
+def _aggregate_column(group_codes: np.ndarray, n_groups: int, column: pd.Series) -> np.ndarray:
+    """
+    Aggregates column values by group
+    :param group_codes: group number of every row
+    :param n_groups: number of groups
+    :param column: values to aggregate
+    :return: comma separated sorted unique string values of every group
+    """
+    not_null = column.notnull().to_numpy()
+    values = pd.Categorical(column[not_null].astype(str))
+    # categories are sorted, so sorting by codes sorts values
+    group_values = pd.DataFrame({"group": group_codes[not_null], "value": values.codes}) \
+        .drop_duplicates() \
+        .sort_values(["group", "value"])
+    groups = group_values["group"].to_numpy()
+    group_strings = values.categories.to_numpy(dtype=object)[group_values["value"].to_numpy()]
+
+    aggregated = np.full(n_groups, "", dtype=object)
+    # most groups have a single value and need no joining
+    is_multi_valued = np.bincount(groups, minlength=n_groups)[groups] > 1
+    aggregated[groups[~is_multi_valued]] = group_strings[~is_multi_valued]
+    joined = pd.Series(group_strings[is_multi_valued]).groupby(groups[is_multi_valued], sort=False).agg(",".join)
+    aggregated[joined.index.to_numpy()] = joined.to_numpy()
+    return aggregated
 
 
-def generate_slim_db(default_db: pd.DataFrame) -> None:
+def generate_slim_db(default_db: pd.DataFrame) -> pd.DataFrame:
     """
     Slim db generator. Write it to /database/ folder
     :param default_db: default vdj db DataFrame
+    :return: slim vdj db DataFrame
     """
-    slim_db = default_db[COMPLEX_SLIM_ANNOT_COLS + SUMMARY_COLS]
+    slim_db = default_db[COMPLEX_SLIM_ANNOT_COLS + SUMMARY_COLS].copy()
     slim_db['j.start'] = default_db['cdr3fix'].apply(lambda x: x['jStart'] if not x == '' else x)
     slim_db['v.end'] = default_db['cdr3fix'].apply(lambda x: x['vEnd'] if not x == '' else x)
-    scores_aggregates = slim_db.groupby(COMPLEX_SLIM_ANNOT_COLS)['vdjdb.score'].max().reset_index()['vdjdb.score']
-    slim_db = slim_db.groupby(COMPLEX_SLIM_ANNOT_COLS).agg(_aggregating_function).reset_index()
-    slim_db['vdjdb.score'] = scores_aggregates
-    slim_db.set_index('gene').to_csv('../database/vdjdb.slim.txt', sep='\t', quotechar='"')
+    slim_db = slim_db.loc[slim_db[COMPLEX_SLIM_ANNOT_COLS].notnull().all(axis=1).to_numpy()]
+
+    groups = slim_db.groupby(COMPLEX_SLIM_ANNOT_COLS, sort=True)
+    group_codes = groups.ngroup().to_numpy()
+    aggregated_db = groups.size().index.to_frame(index=False)
+    for column in slim_db.columns.drop(COMPLEX_SLIM_ANNOT_COLS):
+        if column == 'vdjdb.score':
+            aggregated_db[column] = slim_db[column].groupby(group_codes).max().to_numpy()
+        else:
+            aggregated_db[column] = _aggregate_column(group_codes, len(aggregated_db), slim_db[column])
+
+    aggregated_db.set_index('gene').to_csv('../database/vdjdb.slim.txt', sep='\t', quotechar='"')
+    return aggregated_db
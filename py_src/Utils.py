@@ -1,3 +1,35 @@
+import os
+import hashlib
+from collections import OrderedDict
+
+
+def hash_file(file_name: str) -> str:
+    """
+    Computes a SHA-256 hash of the file content
+    :param file_name: file to hash
+    :return: hexadecimal representation of the hash
+    """
+    sha256_hash = hashlib.sha256()
+    with open(file_name, "rb") as file:
+        for block in iter(lambda: file.read(1 << 20), b""):
+            sha256_hash.update(block)
+    return sha256_hash.hexdigest()
+
+
+def hash_dir(dir_name: str) -> str:
+    """
+    Computes a SHA-256 hash of names and contents of the files in the folder
+    :param dir_name: folder to hash
+    :return: hexadecimal representation of the hash
+    """
+    sha256_hash = hashlib.sha256()
+    for file_name in sorted(os.listdir(dir_name)):
+        file_path = os.path.join(dir_name, file_name)
+        if os.path.isfile(file_path):
+            sha256_hash.update(f"{file_name}:{hash_file(file_path)}".encode("utf-8"))
+    return sha256_hash.hexdigest()
+
+
 def simplify_segment_name(segment_name: str) -> list:
     """
     simplifies segment name
@@ -96,3 +128,59 @@ def translate_linear(seq, reverse=False) -> str:
             aa_seq += translate_dict[codon]
 
     return aa_seq
+
+
+class LRUCache:
+    """
+    Bounded mapping evicting least recently used entries, counts hits, misses and evictions
+    """
+    MISSING = object()
+
+    def __init__(self, max_size: int = None):
+        """
+        :param max_size: max number of stored entries, None for unbounded cache
+        """
+        self.max_size = max_size
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """
+        :param key: key to look up
+        :return: stored value or LRUCache.MISSING
+        """
+        value = self.data.get(key, LRUCache.MISSING)
+        if value is LRUCache.MISSING:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.data.move_to_end(key)
+        return value
+
+    def put(self, key, value) -> None:
+        """
+        stores value evicting the least recently used entries if cache is full
+        """
+        if self.max_size is not None and self.max_size <= 0:
+            return
+        self.data[key] = value
+        self.data.move_to_end(key)
+        if self.max_size is not None:
+            while len(self.data) > self.max_size:
+                self.data.popitem(last=False)
+                self.evictions += 1
+
+    def get_stats(self) -> dict:
+        """
+        :return: dict with cache counters
+        """
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self.data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0
+        }
@@ -0,0 +1,250 @@
+import os
+import ast
+import json
+import pandas as pd
+
+from typing import Optional, Union, Iterable
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+# release table file names without extension
+RELEASE_TABLES = {
+    "full": "vdjdb_full",
+    "default": "vdjdb",
+    "slim": "vdjdb.slim"
+}
+
+# columns with json (or python literal for the full table) encoded dicts
+ENCODED_COLUMNS = ["method", "meta", "cdr3fix", "cdr3fix.alpha", "cdr3fix.beta"]
+
+# number of rows read at once when filtering txt tables
+TSV_CHUNK_SIZE = 100000
+
+
+def _as_list(value: Union[str, Iterable, None]) -> Optional[list]:
+    if value is None:
+        return None
+    return [value] if isinstance(value, (str, int, float)) else list(value)
+
+
+def _decode_value(value) -> Optional[dict]:
+    """
+    :param value: json dump or python literal of a dict
+    :return: decoded dict or None for missing values
+    """
+    if not isinstance(value, str) or not value:
+        return None
+    try:
+        return json.loads(value)
+    except ValueError:
+        return ast.literal_eval(value)
+
+
+def _decode_records(records: list) -> pd.DataFrame:
+    """
+    :param records: list of decoded dicts, empty for missing values
+    :return: frame of the dict fields, integer fields are kept as nullable integers rather than floats with NaNs
+    """
+    decoded = pd.DataFrame.from_records(records)
+    for column in decoded.columns:
+        values = [record.get(column) for record in records]
+        if all(value is None or (isinstance(value, int) and not isinstance(value, bool)) for value in values):
+            decoded[column] = pd.array(values, dtype="Int64")
+    return decoded
+
+
+def _arrow_types_mapper(arrow_type):
+    """
+    :return: nullable pandas dtype for arrow integer types, None to use the default conversion
+    """
+    if pa.types.is_integer(arrow_type):
+        prefix = "UInt" if pa.types.is_unsigned_integer(arrow_type) else "Int"
+        return pd.api.types.pandas_dtype(f"{prefix}{arrow_type.bit_width}")
+    return None
+
+
+class VdjdbTable:
+    """
+    Loaded vdj db table, json encoded columns are decoded into frames of their fields on first access
+    """
+    def __init__(self, df: pd.DataFrame, encoded_columns: dict, column_order: Optional[list] = None):
+        """
+        :param df: table without encoded columns
+        :param encoded_columns: dict of encoded columns by name, either Series of strings or arrow struct arrays
+        :param column_order: column names in the table schema order, plain columns then encoded ones by default
+        """
+        self.df = df
+        self._encoded_columns = encoded_columns
+        self._decoded_columns = {}
+        self._column_order = column_order or list(df.columns) + list(encoded_columns)
+
+    def __len__(self) -> int:
+        return len(self.df)
+
+    @property
+    def columns(self) -> list:
+        return list(self._column_order)
+
+    def __getitem__(self, column: str) -> Union[pd.Series, pd.DataFrame]:
+        """
+        :param column: column name
+        :return: Series for plain columns, frame of dict fields for encoded ones
+        """
+        if column in self._encoded_columns:
+            return self.decode(column)
+        return self.df[column]
+
+    def decode(self, column: str) -> pd.DataFrame:
+        """
+        :param column: encoded column name
+        :return: frame of the dict fields aligned with the table, missing dicts give null rows
+        """
+        if column not in self._decoded_columns:
+            values = self._encoded_columns[column]
+            if pa is not None and isinstance(values, (pa.ChunkedArray, pa.Array)):
+                struct_array = values.combine_chunks() if isinstance(values, pa.ChunkedArray) else values
+                decoded = pd.DataFrame({field.name: child.to_pandas(types_mapper=_arrow_types_mapper) for field, child
+                                        in zip(struct_array.type, struct_array.flatten())})
+            else:
+                decoded = _decode_records([_decode_value(value) or {} for value in values])
+            decoded.index = self.df.index
+            self._decoded_columns[column] = decoded
+        return self._decoded_columns[column]
+
+    def to_records(self, column: str) -> list:
+        """
+        :param column: encoded column name
+        :return: list of dicts as stored in the txt tables, None for missing ones. Method and meta values
+        read from parquet tables are strings except for the build counters, as they are written by ParquetDBGenerator
+        """
+        decoded = self.decode(column)
+        is_missing = decoded.isnull().all(axis=1).to_numpy()
+        return [None if missing else {key: value for key, value in record.items() if pd.notnull(value)}
+                for record, missing in zip(decoded.to_dict("records"), is_missing)]
+
+
+class VdjdbRelease:
+    """
+    Read access to the tables of a database build, parquet tables are used when present and pyarrow is installed
+    """
+    def __init__(self, release_dir: str = "../database/", use_parquet: bool = True):
+        """
+        :param release_dir: folder with the database tables
+        :param use_parquet: read parquet tables if they are present
+        """
+        self.release_dir = release_dir
+        self.use_parquet = use_parquet and pq is not None
+
+    def get_table_file(self, table: str) -> str:
+        """
+        :param table: RELEASE_TABLES key
+        :return: path to the parquet table if it is used, to the txt table otherwise
+        """
+        parquet_file = os.path.join(self.release_dir, f"{RELEASE_TABLES[table]}.parquet")
+        if self.use_parquet and os.path.exists(parquet_file):
+            return parquet_file
+        return os.path.join(self.release_dir, f"{RELEASE_TABLES[table]}.txt")
+
+    @staticmethod
+    def _get_filters(table: str, species: Optional[list], gene: Optional[list], epitope: Optional[list],
+                     min_score: Optional[int]) -> list:
+        """
+        :return: list of (column, operator, value) filters
+        """
+        filters = []
+        if species is not None:
+            filters.append(("species", "in", species))
+        if gene is not None:
+            if table == "full":
+                raise ValueError("gene filter is not supported for the full table, use cdr3.alpha/cdr3.beta columns")
+            filters.append(("gene", "in", gene))
+        if epitope is not None:
+            filters.append(("antigen.epitope", "in", epitope))
+        if min_score is not None:
+            filters.append(("vdjdb.score", ">=", min_score))
+        return filters
+
+    def load(self, table: str = "default", columns: Optional[list] = None,
+             species: Union[str, Iterable, None] = None, gene: Union[str, Iterable, None] = None,
+             epitope: Union[str, Iterable, None] = None, min_score: Optional[int] = None) -> VdjdbTable:
+        """
+        Loads filtered table without materializing the rows that do not pass the filters
+        :param table: RELEASE_TABLES key
+        :param columns: columns to load, all by default
+        :param species: species or list of species to keep
+        :param gene: gene or list of genes to keep
+        :param epitope: epitope or list of epitopes to keep
+        :param min_score: minimal vdjdb.score to keep
+        :return: loaded table
+        """
+        filters = self._get_filters(table, _as_list(species), _as_list(gene), _as_list(epitope), min_score)
+        table_file = self.get_table_file(table)
+        if table_file.endswith(".parquet"):
+            return self._load_parquet(table_file, columns, filters)
+        return self._load_tsv(table_file, columns, filters)
+
+    @staticmethod
+    def _load_parquet(table_file: str, columns: Optional[list], filters: list) -> VdjdbTable:
+        arrow_table = pq.read_table(table_file, columns=columns, filters=filters or None, memory_map=True)
+        encoded_columns = {column: arrow_table.column(column) for column in arrow_table.column_names
+                           if column in ENCODED_COLUMNS}
+        df = arrow_table.drop_columns(list(encoded_columns)).to_pandas()
+        return VdjdbTable(df, encoded_columns, arrow_table.column_names)
+
+    @staticmethod
+    def _load_tsv(table_file: str, columns: Optional[list], filters: list) -> VdjdbTable:
+        filter_columns = [column for column, _, _ in filters]
+        usecols = None if columns is None else list(dict.fromkeys(list(columns) + filter_columns))
+        chunks = []
+        for chunk in pd.read_csv(table_file, sep="\t", usecols=usecols, chunksize=TSV_CHUNK_SIZE,
+                                 keep_default_na=False, na_values=[""], low_memory=False):
+            mask = pd.Series(True, index=chunk.index)
+            for column, operator, value in filters:
+                mask &= chunk[column].isin(value) if operator == "in" else chunk[column] >= value
+            chunks.append(chunk.loc[mask])
+        df = pd.concat(chunks, ignore_index=True)
+        if columns is not None:
+            df = df[list(columns)]
+        encoded_columns = {column: df[column] for column in df.columns if column in ENCODED_COLUMNS}
+        return VdjdbTable(df.drop(columns=list(encoded_columns)), encoded_columns, list(df.columns))
+
+
+def load_vdjdb(release_dir: str = "../database/", table: str = "default", **kwargs) -> VdjdbTable:
+    """
+    Shortcut for VdjdbRelease(release_dir).load(table, ...)
+    """
+    return VdjdbRelease(release_dir).load(table, **kwargs)
+
+
+if __name__ == "__main__":
+    # round trip check of the decoded columns against the dicts stored in the txt tables
+    from ParquetDBGenerator import META_COUNT_FIELDS
+
+    def normalize_parquet_values(column, record):
+        if record is None or column not in ["method", "meta"]:
+            return record
+        return {key: value if key in META_COUNT_FIELDS else str(value) for key, value in record.items()}
+
+    checked = 0
+    for table in ["full", "default"]:
+        txt_table = pd.read_csv(f"../database/{RELEASE_TABLES[table]}.txt", sep="\t", keep_default_na=False, dtype=str)
+        for use_parquet in [False, True] if pq is not None else [False]:
+            release = VdjdbRelease(use_parquet=use_parquet)
+            loaded = release.load(table)
+            assert loaded.columns == list(txt_table.columns), (release.get_table_file(table), loaded.columns)
+            for column in [column for column in ENCODED_COLUMNS if column in txt_table.columns]:
+                expected = [_decode_value(value) for value in txt_table[column]]
+                if use_parquet:
+                    expected = [normalize_parquet_values(column, record) for record in expected]
+                for row, (record, expected_record) in enumerate(zip(loaded.to_records(column), expected)):
+                    # reprs are compared as 2 == 2.0 would hide integers decoded as floats
+                    assert repr(sorted((record or {}).items())) == repr(sorted((expected_record or {}).items())) \
+                        and (record is None) == (expected_record is None), \
+                        (release.get_table_file(table), column, row, record)
+                checked += len(expected)
+    print(f"to_records matches txt tables on {checked} encoded values")
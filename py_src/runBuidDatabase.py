@@ -1,14 +1,23 @@
 import os
 import argparse
+import numpy as np
 import pandas as pd
 import warnings
 from termcolor import cprint
 import hashlib
+from multiprocessing import Pool
+from typing import Tuple
 
-from ChunkQC import ChunkQC, ALL_COLS, SIGNATURE_COLS,gene_match_check, alleles_match_check, is_qq_seq_biologically_valid
+from ChunkQC import ChunkQC, ALL_COLS, SIGNATURE_COLS, gene_match_check, alleles_match_check, \
+    is_qq_seq_biologically_valid, get_error_messages, get_error_summary, encode_qc_errors
 from Cdr3Fixer import Cdr3Fixer
-from DefaultDBGenerator import generate_default_db
+from BuildCache import ChunkCache, PgenCache
+from AlignBestSegments import GermlineIndex, make_germline_index, load_germline_index, realign_all, \
+    update_segments, json2tuples
+from DefaultDBGenerator import generate_default_db, encode_complex_columns
 from SlimDBGenerator import generate_slim_db
+from MotifsScoresAssembler import write_scored_tables
+from ParquetDBGenerator import generate_parquet_db
 from ScoreFactory import VdjdbScoreFactory
 
 def hash_string(input_string: str) -> str:
@@ -37,79 +46,208 @@ aggregated_species = antigen_df["antigen.species"].to_dict()
 aggregated_gene = antigen_df["antigen.gene"].to_dict()
 
 
+def read_chunk(chunk_file: str) -> Tuple[pd.DataFrame, dict]:
+    """
+    Reads chunk, removes duplicates, applies QC and antigen nomenclature patches
+    :param chunk_file: name of the file in ../chunks/ folder
+    :return: chunk DataFrame and dict of QC error messages
+    """
+    chunk_df = pd.read_csv(
+        f"../chunks/{chunk_file}",
+        sep="\t",
+        encoding_errors="ignore",
+        keep_default_na=False,
+        na_values=['']
+                           )
+    chunk_df = chunk_df.drop_duplicates(subset=SIGNATURE_COLS)
+    chunk_qc = ChunkQC(chunk_df)
+    chunk_error_messages = get_error_messages(chunk_qc.process_chunk())
+
+    for antigen_column, antigen_patch in [("antigen.species", aggregated_species), ("antigen.gene", aggregated_gene)]:
+        patched_mask = chunk_df["antigen.epitope"].isin(antigen_patch.keys())
+        chunk_df[antigen_column] = chunk_df["antigen.epitope"].map(antigen_patch).where(patched_mask,
+                                                                                      chunk_df[antigen_column])
+
+    return chunk_df[ALL_COLS].copy(), chunk_error_messages
+
+
+def fix_chunks(chunks_df: pd.DataFrame, cdr3_fixer: Cdr3Fixer, jobs: int = 1) -> pd.DataFrame:
+    """
+    Guesses missing V/J segments and fixes CDR3 sequences of both chains (stage I)
+    :param chunks_df: QC-ed chunks
+    :param cdr3_fixer: Cdr3Fixer instance
+    :param jobs: number of processes for fixing
+    :return: fixed chunks with cdr3fix.alpha and cdr3fix.beta columns
+    """
+    for gene in ["alpha", "beta"]:
+        has_cdr3 = chunks_df[f"cdr3.{gene}"].notnull()
+
+        for segment, five_prime in [("v", True), ("j", False)]:
+            segment_column = f"{segment}.{gene}"
+            guess_mask = has_cdr3 & chunks_df[segment_column].isnull()
+            chunks_df[segment_column] = chunks_df[segment_column].astype(object)
+            if guess_mask.any():
+                chunks_df.loc[guess_mask, segment_column] = cdr3_fixer.guess_ids(
+                    chunks_df.loc[guess_mask, f"cdr3.{gene}"], chunks_df.loc[guess_mask, "species"], gene, five_prime)
+
+        fixer_results = cdr3_fixer.fix_many(chunks_df.loc[has_cdr3], gene, jobs)
+        # remake fixer results
+        for column, fixed_values in [(f"cdr3.{gene}", fixer_results["cdr3"]),
+                                     (f"v.{gene}", fixer_results["vId"]),
+                                     (f"j.{gene}", fixer_results["jId"]),
+                                     (f"cdr3fix.{gene}", fixer_results.to_dict("records"))]:
+            values = np.full(len(chunks_df), None, dtype=object)
+            values[has_cdr3.to_numpy()] = list(fixed_values)
+            chunks_df[column] = values
+    return chunks_df
+
+
+def needs_realignment(cdr3fix) -> bool:
+    """
+    :param cdr3fix: stage I fixer result dict or None
+    :return: True if stage I failed to fix the cdr3 or fixed it to a non-canonical one
+    """
+    return isinstance(cdr3fix, dict) and not (cdr3fix["good"] and cdr3fix["vCanonical"] and cdr3fix["jCanonical"])
+
+
+def realign_chunks(master_table: pd.DataFrame, germline_index: GermlineIndex,
+                   jobs: int = 1) -> Tuple[pd.DataFrame, int]:
+    """
+    Realigns cdr3 sequences to nucleotide germlines to update V/J segments of rows stage I
+    did not fix well (stage II)
+    :param master_table: table of fixed chunks
+    :param germline_index: GermlineIndex of segments
+    :param jobs: number of processes for realignment
+    :return: table with updated segments and cdr3fix columns and number of updated segments
+    """
+    realigned_count = 0
+    for gene, seg_gene_type in [("alpha", "TRA"), ("beta", "TRB")]:
+        columns = [f"cdr3.{gene}", f"cdr3fix.{gene}", f"v.{gene}", f"j.{gene}"]
+        realign_mask = np.array([needs_realignment(cdr3fix) for cdr3fix in master_table[f"cdr3fix.{gene}"]], dtype=bool)
+        if not realign_mask.any():
+            continue
+        realign_df = master_table.loc[realign_mask, columns + ["species"]]
+        realigned = realign_all(json2tuples(realign_df, f"cdr3.{gene}", seg_gene_type), germline_index, jobs)
+        realign_df, updates = update_segments(realign_df, realigned, *columns)
+        for column in columns[1:]:
+            values = master_table[column].to_numpy(dtype=object, copy=True)
+            values[realign_mask] = realign_df[column].to_numpy()
+            master_table[column] = values
+        realigned_count += len(updates)
+    return master_table, realigned_count
+
+
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser(description="Arguments for database building")
     parser.add_argument("--chunks-to-build", help="chunks to include in database", nargs="+", type=str)
     parser.add_argument("--no2fix", action="store_true", help="Fix did not occurred if enabled")
+    parser.add_argument("--cache-dir", default="../cache/chunks/", type=str,
+                        help="folder for processed chunks cache")
+    parser.add_argument("--no-cache", action="store_true", help="Process all chunks ignoring the chunks cache")
+    parser.add_argument("--jobs", default=1, type=int, help="number of processes for chunks reading, QC and fixing")
+    parser.add_argument("--fixer-cache-size", default=1 << 18, type=int,
+                        help="max number of memoized Cdr3Fixer results per method, 0 to disable")
+    parser.add_argument("--fixer-cache-file", default=None, type=str,
+                        help="file to load memoized Cdr3Fixer results from and save them to")
+    parser.add_argument("--dump-segment-aliases", default=None, type=str,
+                        help="file to write segment name resolution index to for auditing")
+    parser.add_argument("--realign", action="store_true",
+                        help="Realign cdr3 sequences not fixed well by stage I to nucleotide germlines (stage II)")
+    parser.add_argument("--pgen-cache-file", default="../cache/pgen.sqlite", type=str,
+                        help="file to keep computed Pgen values in between builds")
+    parser.add_argument("--no-pgen-cache", action="store_true", help="Compute Pgen values ignoring the Pgen cache")
+    parser.add_argument("--no-pgen", action="store_true",
+                        help="Do not compute Pgen, vdjdb.pgen.score is 0 for all records then, mirpy is not needed")
+    parser.add_argument("--pgen-jobs", default=None, type=int,
+                        help="number of processes for Pgen computation, all available CPUs by default")
+    parser.add_argument("--pgen-chunksize", default=None, type=int, help="number of CDR3 sequences per Pgen task")
+    parser.add_argument("--no-parquet", action="store_true",
+                        help="Do not write parquet versions of the tables, they are written only if pyarrow is installed")
+    parser.add_argument("--cluster-members", default=None, type=str,
+                        help="cluster_members.txt of vdjdb-motifs to write *scored.txt tables with")
     args = parser.parse_args()
 
-    cprint("Reading, concatenating, and QC of chunks", "magenta")
+    cprint("Reading, concatenating, QC and fixing CDR3 sequences (stage I) of chunks", "magenta")
 
     chunk_files = set(os.listdir("../chunks")).intersection(args.chunks_to_build) if \
         args.chunks_to_build else os.listdir("../chunks")
 
-    chunk_files = [chunk_file for chunk_file in chunk_files if chunk_file[0] != "." and chunk_file.endswith(".txt")]
+    chunk_files = sorted(chunk_file for chunk_file in chunk_files if chunk_file[0] != "." and chunk_file.endswith(".txt"))
 
     cprint(f"Total number of chunks: {len(chunk_files)}", "magenta")
+    chunk_cache = None if args.no_cache else ChunkCache(args.cache_dir)
+    processed_chunks = {}
+    cdr3_fixer = None
+    if chunk_cache:
+        for chunk_file in chunk_files:
+            cached_chunk = chunk_cache.load(f"../chunks/{chunk_file}")
+            if cached_chunk is not None:
+                processed_chunks[chunk_file] = cached_chunk
+
+    # largest chunks are scheduled first so that they do not block the pool tail
+    dirty_chunk_files = sorted([chunk_file for chunk_file in chunk_files if chunk_file not in processed_chunks],
+                               key=lambda x: os.path.getsize(f"../chunks/{x}"), reverse=True)
+    if dirty_chunk_files:
+        if args.jobs > 1:
+            with Pool(min(args.jobs, len(dirty_chunk_files))) as pool:
+                read_chunks = pool.map(read_chunk, dirty_chunk_files, chunksize=1)
+        else:
+            read_chunks = map(read_chunk, dirty_chunk_files)
+
+        cdr3_fixer = Cdr3Fixer("../res/segments.txt", "../res/segments.aaparts.txt",
+                               cache_size=args.fixer_cache_size, cache_file_name=args.fixer_cache_file)
+        read_chunks = list(read_chunks)
+        dirty_chunks_df = fix_chunks(pd.concat([chunk_df for chunk_df, _ in read_chunks], keys=dirty_chunk_files),
+                                     cdr3_fixer, args.jobs)
+        error_messages_by_chunk = {chunk_file: chunk_error_messages for chunk_file, (_, chunk_error_messages)
+                                   in zip(dirty_chunk_files, read_chunks)}
+        for chunk_file, chunk_df in dirty_chunks_df.groupby(level=0, sort=False):
+            chunk_df = chunk_df.droplevel(0)
+            chunk_error_messages = error_messages_by_chunk[chunk_file]
+            if chunk_cache:
+                chunk_cache.store(f"../chunks/{chunk_file}", chunk_df, chunk_error_messages)
+            processed_chunks[chunk_file] = chunk_df, chunk_error_messages
+
+        for method_name, stats in cdr3_fixer.cache_info().items():
+            cprint(f"Cdr3Fixer.{method_name} cache: {stats['hits']} hits, {stats['misses']} misses, "
+                   f"{stats['evictions']} evictions ({stats['hit_rate']:.1%} hit rate)", "magenta")
+        if args.dump_segment_aliases:
+            cdr3_fixer.dump_resolution_index(args.dump_segment_aliases)
+        scanner_stats = cdr3_fixer.get_scanner_stats()
+        cprint(f"KmerScanners: {scanner_stats['built']} built, {scanner_stats['used']} used", "magenta")
+        if args.fixer_cache_file:
+            cdr3_fixer.save_cache(args.fixer_cache_file)
+
     chunk_df_list = []
     for chunk_file in chunk_files:
-        chunk_df = pd.read_csv(
-            f"../chunks/{chunk_file}",
-            sep="\t",
-            encoding_errors="ignore",
-            keep_default_na=False,
-            na_values=['']
-                               )
-        chunk_df = chunk_df.drop_duplicates(subset=SIGNATURE_COLS)
-        chunk_qc = ChunkQC(chunk_df)
-        chunk_error_messages = chunk_qc.process_chunk()
+        chunk_df, chunk_error_messages = processed_chunks[chunk_file]
 
         if chunk_error_messages.keys():
             print(chunk_file)
-            print(dict(chunk_error_messages))
+            print(chunk_error_messages)
+            error_summary = get_error_summary(encode_qc_errors(chunk_error_messages))
+            print(error_summary[error_summary > 0].to_string())
             warn_message = f"There were errors processing {chunk_file}"
             warnings.warn(warn_message)
 
-        chunk_df["antigen.species"] = chunk_df.T.apply(lambda x: aggregated_species.get(x["antigen.epitope"])
-            if aggregated_species.get(x["antigen.epitope"]) else x["antigen.species"])
-        chunk_df["antigen.gene"] = chunk_df.T.apply(lambda x: aggregated_gene.get(x["antigen.epitope"])
-            if aggregated_gene.get(x["antigen.epitope"]) else x["antigen.gene"])
-
         chunk_df_list.append(chunk_df)
 
-    os.makedirs("../database/", exist_ok=True)
-    master_table = pd.concat(chunk_df_list)[ALL_COLS]
+    if chunk_cache:
+        cprint(f"Chunks cache: {chunk_cache.get_stats()}", "magenta")
 
-    cprint("Fixing CDR3 sequences (stage I)", "magenta")
-
-    cdr3_fixer = Cdr3Fixer("../res/segments.txt", "../res/segments.aaparts.txt")
+    os.makedirs("../database/", exist_ok=True)
+    master_table = pd.concat(chunk_df_list)
 
-    for gene in ["alpha", "beta"]:
-        master_table[f"v.{gene}"] = master_table.T.apply(
-            lambda x: cdr3_fixer.guess_id(x[f"cdr3.{gene}"], x.species, gene, True
-                                          ) if pd.isnull(x[f"v.{gene}"]) and not pd.isnull(x[f"cdr3.{gene}"])
-            else x[f"v.{gene}"])
-
-        master_table[f"j.{gene}"] = master_table.T.apply(
-            lambda x: cdr3_fixer.guess_id(x[f"cdr3.{gene}"], x.species, gene, False
-                                          ) if pd.isnull(x[f"j.{gene}"]) and not pd.isnull(x[f"cdr3.{gene}"])
-            else x[f"j.{gene}"])
-
-        fixer_results = master_table.T.apply(
-            lambda x: cdr3_fixer.fix_both(x[f"cdr3.{gene}"],
-                                          x[f"v.{gene}"],
-                                          x[f"j.{gene}"],
-                                          x.species,
-                                          ) if not pd.isnull(x[f"cdr3.{gene}"]) else None)
-        # remake fixer results
-        master_table[f"cdr3.{gene}"] = fixer_results.apply(lambda x: x.cdr3 if x else None)
-        master_table[f"v.{gene}"] = fixer_results.apply(lambda x: x.vId if x else None)
-        master_table[f"j.{gene}"] = fixer_results.apply(lambda x: x.jId if x else None)
-        master_table[f"cdr3fix.{gene}"] = fixer_results.apply(lambda x: x.results_to_dict() if x else None)
+    if args.realign:
+        cprint("Realigning CDR3 sequences not fixed by stage I (stage II)", "magenta")
+        germline_index = make_germline_index(cdr3_fixer.segments) if cdr3_fixer \
+            else load_germline_index("../res/segments.txt")
+        master_table, realigned_count = realign_chunks(master_table, germline_index, args.jobs)
+        cprint(f"Realigned {realigned_count} V/J segments", "magenta")
 
     score_factory = VdjdbScoreFactory(master_table)
-    master_table['vdjdb.score'] = master_table.T.apply(lambda x: score_factory.get_score(x))
+    master_table['vdjdb.score'] = score_factory.get_scores()
 
     master_table['index_seq'] = master_table['cdr3.alpha'] + master_table['v.alpha'] + master_table[
         'j.alpha'] + master_table['cdr3.beta'] + master_table['v.beta'] + master_table['j.beta'] + \
@@ -151,8 +289,20 @@ if __name__ == "__main__":
 
     #master_table = master_table.loc[final_mask & final_mask_alleles & final_mask_biological_cdr3]
     cprint("Generating and writing default database", 'magenta')
-    default_db = generate_default_db(master_table)
+    pgen_cache = None if args.no_pgen_cache or args.no_pgen else PgenCache(args.pgen_cache_file)
+    default_db = generate_default_db(master_table, pgen_cache, args.pgen_jobs, args.pgen_chunksize, args.no_pgen)
+    if pgen_cache:
+        pgen_cache.close()
 
     cprint("Generating and writing slim database", "magenta")
-    generate_slim_db(default_db)
+    slim_db = generate_slim_db(default_db)
+
+    if not args.no_parquet:
+        cprint("Writing parquet tables", "magenta")
+        generate_parquet_db(master_table, default_db, slim_db)
+
+    if args.cluster_members:
+        cprint("Writing tables with motif cluster members", "magenta")
+        write_scored_tables(master_table, slim_db, encode_complex_columns(default_db),
+                            pd.read_csv(args.cluster_members, sep="\t"))
     cprint("DB generation successfully finished!", "magenta")
\ No newline at end of file
@@ -47,6 +47,7 @@ DD=`date +%F`
 mkdir vdjdb-$DD
 cp ../summary/vdjdb_summary_embed.html vdjdb-$DD/
 cp *.txt vdjdb-$DD/
+cp *.parquet vdjdb-$DD/ 2>/dev/null
 
 # Update latest version
 